@@ -0,0 +1,319 @@
+"""
+Load generator for the HTTP and websocket paths.
+
+Boots the app against a temporary database, seeds it, and drives sign in,
+wall reads, posts and websocket LOGIN/PING sessions against it. Results
+(throughput, latency percentiles, peak RSS) are printed as JSON.
+
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --baseline bench.json
+
+With --baseline the run fails (exit code 1) when a scenario's throughput drops
+or its p95 latency grows by more than --tolerance compared to the baseline.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Twidder benchmarks.")
+    parser.add_argument("--users", type=int, default=200, help="Number of seeded users.")
+    parser.add_argument("--messages", type=int, default=20000, help="Number of seeded messages.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients per HTTP scenario.")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per HTTP scenario.")
+    parser.add_argument("--sign-ins", type=int, default=20, help="Requests for the (bcrypt bound) sign in scenario.")
+    parser.add_argument("--sockets", type=int, default=50, help="Concurrent websocket sessions.")
+    parser.add_argument("--pings", type=int, default=20, help="PINGs per websocket session.")
+    parser.add_argument("--scenarios", default="sign_in,wall_read,post,websocket", help="Comma separated scenarios to run.")
+    parser.add_argument("--output", help="Write the results to this file as well.")
+    parser.add_argument("--baseline", help="Compare against the results in this file.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression against the baseline.")
+    return parser.parse_args()
+
+def configure_environment(directory: str):
+    # Must happen before twidder is imported, the modules read their config on import.
+    os.environ["TWIDDER_DATABASE"] = os.path.join(directory, "database.db")
+    os.environ["TWIDDER_EVENTS_DB"] = os.path.join(directory, "events.db")
+    os.environ["TWIDDER_GEOCODE_CACHE"] = ""
+    os.environ.setdefault("TWIDDER_DB_POOL_SIZE", "32")
+    # The scenarios measure throughput, not the limits a real client would hit.
+    os.environ["TWIDDER_RATE_LIMIT"] = "0"
+
+PASSWORD = "benchmark"
+
+def seed(users: int, messages: int) -> list[str]:
+    import bcrypt
+    from twidder.backend.pool import pool
+
+    # Hashing once keeps seeding fast, sign in still pays the full bcrypt cost.
+    password_hash = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt()).decode()
+    emails = [f"user{i}@bench.test" for i in range(users)]
+
+    with pool.connection() as con:
+        con.executemany(
+            "INSERT INTO User (Email, PasswordHash, FirstName, FamilyName, Gender, City, Country) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(email, password_hash, "Bench", "User", "unspecified", "Linkoping", "Sweden") for email in emails],
+        )
+        con.executemany(
+            "INSERT INTO Message (Recipient, Author, Contents, Region) VALUES (?, ?, ?, ?)",
+            [(random.choice(emails), random.choice(emails), f"Message {i}", None) for i in range(messages)],
+        )
+
+    return emails
+
+class StubResolver:
+    def resolve(self, lat, lon):
+        return "Benchmark, XX"
+
+def start_server():
+    from werkzeug.serving import make_server
+    from twidder import app
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values: return 0
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize(latencies: list[float], errors: int, duration: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "duration": duration,
+        "throughput": len(latencies) / duration if duration else 0,
+        "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+def run_concurrently(concurrency: int, total: int, make_worker):
+    """
+    Runs `total` operations split over `concurrency` threads. `make_worker`
+    returns a callable performing one operation and returning whether it succeeded.
+    """
+
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+    remaining = [total]
+
+    def loop():
+        nonlocal errors
+        operation = make_worker()
+        while True:
+            with lock:
+                if remaining[0] <= 0: return
+                remaining[0] -= 1
+
+            start = time.perf_counter()
+            try:
+                ok = operation()
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                if ok: latencies.append(elapsed)
+                else: errors += 1
+
+    threads = [threading.Thread(target=loop) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+def create_sessions(emails: list[str]) -> list[str]:
+    from twidder.backend import database_helper
+    from twidder.backend.lib import create_token
+
+    tokens = []
+    for email in emails:
+        token = create_token()
+        database_helper.insert_session(token, email)
+        tokens.append(token)
+    return tokens
+
+def bench_sign_in(base: str, emails: list[str], args):
+    import requests
+
+    def make_worker():
+        session = requests.Session()
+        return lambda: session.post(f"{base}/sign_in", json={ "username": random.choice(emails), "password": PASSWORD }).status_code == 200
+
+    return run_concurrently(args.concurrency, args.sign_ins, make_worker)
+
+def bench_wall_read(base: str, emails: list[str], tokens: list[str], args):
+    import requests
+
+    def make_worker():
+        session = requests.Session()
+        session.headers["Authorization"] = random.choice(tokens)
+        return lambda: session.get(f"{base}/get_user_messages_by_email/{random.choice(emails)}").status_code == 200
+
+    return run_concurrently(args.concurrency, args.requests, make_worker)
+
+def bench_post(base: str, emails: list[str], tokens: list[str], args):
+    import requests
+
+    def make_worker():
+        session = requests.Session()
+        session.headers["Authorization"] = random.choice(tokens)
+        return lambda: session.post(f"{base}/post_message", json={
+            "message": "Benchmark post",
+            "email": random.choice(emails),
+            "coords": { "lat": 58.41, "lon": 15.62 },
+        }).status_code == 201
+
+    return run_concurrently(args.concurrency, args.requests, make_worker)
+
+def bench_websocket(base: str, tokens: list[str], args):
+    import simple_websocket
+
+    url = base.replace("http://", "ws://") + "/socket"
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.sockets)
+
+    def session(token: str):
+        nonlocal errors
+        local_latencies = []
+        local_errors = 0
+        try:
+            ws = simple_websocket.Client.connect(url)
+        except Exception:
+            with lock: errors += args.pings + 1
+            barrier.abort()
+            return
+
+        try:
+            ws.send(json.dumps({ "id": 0, "message": { "action": "LOGIN", "data": token } }))
+            response = json.loads(ws.receive(10) or "{}")
+            if response.get("action") != "LOGGED_IN":
+                local_errors += 1
+
+            # Hold every session open at the same time.
+            barrier.wait(30)
+
+            for i in range(args.pings):
+                start = time.perf_counter()
+                ws.send(json.dumps({ "id": i + 1, "message": { "action": "PING", "data": i } }))
+                while True:
+                    response = ws.receive(10)
+                    if response is None:
+                        local_errors += 1
+                        break
+                    if json.loads(response).get("action") == "PONG":
+                        local_latencies.append(time.perf_counter() - start)
+                        break
+        except Exception:
+            local_errors += 1
+        finally:
+            # The server may have closed it already, its errors must still be counted.
+            with contextlib.suppress(Exception):
+                ws.close()
+
+        with lock:
+            latencies.extend(local_latencies)
+            errors += local_errors
+
+    threads = [threading.Thread(target=session, args=(tokens[i % len(tokens)],)) for i in range(args.sockets)]
+    start = time.perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for (name, current) in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None: continue
+
+        if previous["throughput"] and current["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {current['throughput']:.1f}/s vs {previous['throughput']:.1f}/s")
+        if previous["p95_ms"] and current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {current['p95_ms']:.2f} ms vs {previous['p95_ms']:.2f} ms")
+        if current["errors"] > previous["errors"]:
+            regressions.append(f"{name}: {current['errors']} errors vs {previous['errors']}")
+    return regressions
+
+def main():
+    args = parse_args()
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+
+    directory = tempfile.mkdtemp(prefix="twidder-bench-")
+    configure_environment(directory)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    # The app logs with print(), keep stdout for the results.
+    with contextlib.redirect_stdout(sys.stderr):
+        from twidder.backend.geocode import set_region_resolver
+
+        set_region_resolver(StubResolver())
+        emails = seed(args.users, args.messages)
+        server = start_server()
+        base = f"http://127.0.0.1:{server.server_port}"
+
+        # Sessions for the protected scenarios, created directly to skip bcrypt.
+        tokens = create_sessions(emails[:max(args.concurrency, args.sockets)])
+
+        results = {
+            "config": {
+                "users": args.users,
+                "messages": args.messages,
+                "concurrency": args.concurrency,
+                "requests": args.requests,
+                "sockets": args.sockets,
+                "pings": args.pings,
+            },
+            "scenarios": {},
+        }
+
+        for name in scenarios:
+            if name == "sign_in":
+                results["scenarios"][name] = bench_sign_in(base, emails, args)
+            elif name == "wall_read":
+                results["scenarios"][name] = bench_wall_read(base, emails, tokens, args)
+            elif name == "post":
+                results["scenarios"][name] = bench_post(base, emails, tokens, args)
+            elif name == "websocket":
+                results["scenarios"][name] = bench_websocket(base, tokens, args)
+            else:
+                raise SystemExit(f"Unknown scenario {name}.")
+
+        server.shutdown()
+
+    # Client and server share the process, so this is an upper bound for the server.
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    output = json.dumps(results, indent=4)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(output)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,16 @@
 import subprocess
 
 def run():
-    subprocess.run(["./start.sh"], shell=True)
\ No newline at end of file
+    subprocess.run(["./start.sh"], shell=True)
+
+def run_socket():
+    from twidder.websocket import async_server
+    async_server.main()
+
+def rebuild_search():
+    from twidder.backend import database_helper
+    database_helper.rebuild_search_index()
+
+def bulk():
+    from twidder.backend import bulk
+    bulk.main()
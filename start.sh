@@ -1,3 +1,20 @@
 #!/bin/sh
 
-gunicorn -b 127.0.0.1:5000  --workers 1 --threads 100 twidder:app
\ No newline at end of file
+WORKERS=${TWIDDER_WORKERS:-1}
+
+# Workers share websocket notifications through an event log when there is more than one.
+if [ "$WORKERS" -gt 1 ]; then
+    export TWIDDER_NOTIFY_BUS=${TWIDDER_NOTIFY_BUS:-sqlite}
+fi
+
+# Serve websockets from the asyncio server instead of gunicorn threads, a reverse
+# proxy routes /socket to it (TWIDDER_SOCKET_PORT).
+if [ "${TWIDDER_SOCKET_SERVER:-thread}" = "async" ]; then
+    export TWIDDER_NOTIFY_BUS=sqlite
+    python -m twidder.websocket.async_server &
+fi
+
+# Only reachable through the reverse proxy, which must append the client address to
+# X-Forwarded-For. Rate limits key on it, set TWIDDER_RATE_LIMIT_PROXIES to the number
+# of proxies in front (default 1).
+gunicorn -b 127.0.0.1:5000  --workers $WORKERS --threads 100 twidder:app
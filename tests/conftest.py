@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# Must happen before twidder is imported, the modules read their config on import.
+_directory = tempfile.mkdtemp(prefix="twidder-tests-")
+os.environ["TWIDDER_DATABASE"] = os.path.join(_directory, "database.db")
+os.environ["TWIDDER_EVENTS_DB"] = os.path.join(_directory, "events.db")
+os.environ["TWIDDER_GEOCODE_CACHE"] = ""
@@ -0,0 +1,19 @@
+from twidder.backend.geocode import MAX_DISTANCE_KM, REGIONS_FILE, OfflineRegionResolver
+
+resolver = OfflineRegionResolver(REGIONS_FILE, MAX_DISTANCE_KM)
+
+def test_listed_city():
+    assert resolver.resolve(59.33, 18.07) == "Stockholm, SE"
+
+def test_between_cities_resolves_to_the_nearest():
+    # Stockholm and Uppsala are ~64 km apart.
+    assert resolver.resolve(59.75, 17.70) == "Uppsala, SE"
+    assert resolver.resolve(59.45, 17.95) == "Stockholm, SE"
+
+def test_sparse_area_resolves_to_no_region():
+    # Inland Västerbotten, the closest listed city is Skellefteå ~190 km away.
+    assert resolver.resolve(65.0, 17.0) == None
+
+def test_polar_and_antimeridian():
+    assert resolver.resolve(89.9, 0.0) == None
+    assert resolver.resolve(0.0, 179.9) == None
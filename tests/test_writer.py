@@ -0,0 +1,62 @@
+import os
+import tempfile
+import threading
+
+import pytest
+
+from twidder.backend.pool import ConnectionPool
+from twidder.backend.writer import GroupCommitWriter
+
+def create_table(con):
+    con.execute("CREATE TABLE Item (Name TEXT NOT NULL)")
+    con.commit()
+
+def make_writer(timeout: float) -> GroupCommitWriter:
+    path = os.path.join(tempfile.mkdtemp(prefix="twidder-writer-"), "writer.db")
+    return GroupCommitWriter(ConnectionPool(path, 2, 5, create_table), 1, 0, timeout)
+
+def insert(name: str):
+    return lambda con: con.execute("INSERT INTO Item VALUES (?)", (name,)).rowcount
+
+def names(writer: GroupCommitWriter) -> list[str]:
+    with writer.pool.connection() as con:
+        return [name for (name,) in con.execute("SELECT Name FROM Item ORDER BY Name")]
+
+def test_run_returns_the_result():
+    writer = make_writer(5)
+    assert writer.run(insert("a")) == 1
+    assert names(writer) == ["a"]
+    writer.shutdown(5)
+
+def test_timed_out_write_is_never_committed():
+    writer = make_writer(0.1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking(con):
+        started.set()
+        release.wait(5)
+        return insert("first")(con)
+
+    # Occupies the writer thread, the next write stays queued behind it.
+    first = writer.submit(blocking)
+    assert started.wait(5)
+    with pytest.raises(TimeoutError):
+        writer.run(insert("second"))
+
+    release.set()
+    assert first.result(5) == 1
+    writer.shutdown(5)
+    assert names(writer) == ["first"]
+
+def test_write_in_a_running_batch_is_waited_for():
+    writer = make_writer(0.1)
+
+    def slow(con):
+        threading.Event().wait(0.3)
+        return insert("slow")(con)
+
+    # Past the timeout but already running, reporting a failure would be wrong.
+    assert writer.run(slow) == 1
+    assert names(writer) == ["slow"]
+    writer.shutdown(5)
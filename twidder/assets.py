@@ -0,0 +1,145 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from flask import Response, request
+
+# Optional, only gzip is served without it.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Reread assets whose file changed, for development.
+ASSETS_RELOAD = os.environ.get("TWIDDER_ASSETS_RELOAD", "0") == "1"
+# Hashed URLs never change content, so they can be cached for a year.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# Compressing these again doesn't gain anything.
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# Local href/src attributes in HTML, rewritten to carry the content hash.
+ASSET_REFERENCE = re.compile(r'''(href|src)="([^":/?#]+)"''')
+
+class Asset:
+    """
+    A static file held in memory together with its precompressed variants.
+    """
+
+    path: str
+    mimetype: str
+    mtime: float
+    # Short content hash, used in ?v= URLs and as the ETag.
+    version: str
+    # Content-Encoding ("identity", "gzip", "br") -> body.
+    variants: dict[str, bytes]
+
+    def __init__(self, path: str, content: bytes, mtime: float):
+        self.path = path
+        self.mtime = mtime
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.version = hashlib.sha256(content).hexdigest()[:12]
+
+        self.variants = { "identity": content }
+        if self.mimetype.startswith(COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(compressed) < len(content):
+                self.variants["gzip"] = compressed
+            if brotli != None:
+                compressed = brotli.compress(content, quality=11)
+                if len(compressed) < len(content):
+                    self.variants["br"] = compressed
+
+    def choose_encoding(self) -> str:
+        # Best compression the client accepts.
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and request.accept_encodings[encoding] > 0:
+                return encoding
+        return "identity"
+
+class AssetStore:
+    """
+    Loads every file in `directory` at startup. HTML files get their references
+    to other assets rewritten to content-hashed URLs, so those can be cached
+    forever while the HTML itself is revalidated with its ETag.
+    """
+
+    directory: str
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+        self._assets: dict[str, Asset] = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def _read(self, name: str) -> tuple[bytes, float]:
+        path = os.path.join(self.directory, name)
+        with open(path, "rb") as fp:
+            return (fp.read(), os.path.getmtime(path))
+
+    def load(self):
+        assets = {}
+        names = sorted(os.listdir(self.directory))
+        for name in names:
+            if name.endswith(".html") or not os.path.isfile(os.path.join(self.directory, name)): continue
+            (content, mtime) = self._read(name)
+            assets[name] = Asset(name, content, mtime)
+
+        # After everything they may reference.
+        for name in names:
+            if not name.endswith(".html"): continue
+            (content, mtime) = self._read(name)
+            assets[name] = Asset(name, self.rewrite_references(content, assets), mtime)
+
+        with self._lock:
+            self._assets = assets
+
+    def rewrite_references(self, html: bytes, assets: dict[str, Asset]) -> bytes:
+        def versioned(match: re.Match) -> str:
+            (attribute, name) = match.groups()
+            asset = assets.get(name)
+            if asset is None: return match.group(0)
+            return f'{attribute}="{name}?v={asset.version}"'
+
+        return ASSET_REFERENCE.sub(versioned, html.decode()).encode()
+
+    def get(self, name: str) -> Asset | None:
+        with self._lock:
+            asset = self._assets.get(name)
+
+        if ASSETS_RELOAD and asset != None:
+            try:
+                changed = os.path.getmtime(os.path.join(self.directory, name)) != asset.mtime
+            except OSError:
+                changed = True
+            if changed:
+                self.load()
+                with self._lock:
+                    asset = self._assets.get(name)
+
+        return asset
+
+def asset_response(asset: Asset) -> Response:
+    encoding = asset.choose_encoding()
+    etag = asset.version if encoding == "identity" else f"{asset.version}-{encoding}"
+
+    # Only URLs carrying the current hash are safe to cache without asking again.
+    if request.args.get("v") == asset.version:
+        cache_control = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    else:
+        cache_control = "no-cache"
+
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": cache_control,
+        "Vary": "Accept-Encoding",
+    }
+
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(asset.variants[encoding], mimetype=asset.mimetype, headers=headers)
@@ -0,0 +1,328 @@
+"""
+Bulk import and export of users, sessions and messages as NDJSON or CSV.
+
+    python -m twidder.backend.bulk import users users.ndjson --hash-rounds 4
+    python -m twidder.backend.bulk import messages messages.csv
+    python -m twidder.backend.bulk export messages - > messages.ndjson
+
+Files are streamed in chunks, so memory stays bounded no matter their size.
+An import runs in a single transaction. The table's indexes and triggers are
+dropped while it loads and recreated afterwards, then the search index and
+wall versions are brought up to date. Writers in a running server wait for
+the whole import, so run big ones while it is stopped.
+
+Users take either `password_hash` or a plaintext `password`, which is hashed
+on a thread pool since bcrypt releases the GIL.
+"""
+
+import argparse
+import contextlib
+import csv
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, ContextManager, Iterable, Iterator, TextIO
+
+import bcrypt
+
+from .migrations import migrate
+from .pool import DATABASE_PATH, SESSION_LIFETIME
+
+CHUNK_SIZE = 10000
+# Only for connections doing a bulk load, everything is committed once at the end anyway.
+BULK_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -262144",
+    "PRAGMA busy_timeout = 5000",
+]
+PROGRESS_INTERVAL = 100000
+
+class Table:
+    name: str
+    # File fields, in the order they are exported.
+    fields: list[str]
+    select: str
+    insert: str
+
+    def __init__(self, name: str, fields: list[str], select: str, insert: str):
+        self.name = name
+        self.fields = fields
+        self.select = select
+        self.insert = insert
+
+TABLES = {
+    "users": Table(
+        "User",
+        ["email", "password_hash", "firstname", "familyname", "gender", "city", "country"],
+        "SELECT Email, PasswordHash, FirstName, FamilyName, Gender, City, Country FROM User ORDER BY Email",
+        "INSERT {} INTO User (Email, PasswordHash, FirstName, FamilyName, Gender, City, Country) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    ),
+    "sessions": Table(
+        "Session",
+        ["token", "email", "created", "last_seen", "expires_at"],
+        "SELECT Token, Email, Created, LastSeen, ExpiresAt FROM Session ORDER BY Token",
+        "INSERT {} INTO Session (Token, Email, Created, LastSeen, ExpiresAt) VALUES (?, ?, ?, ?, ?)",
+    ),
+    "messages": Table(
+        "Message",
+        ["id", "recipient", "author", "contents", "region", "created"],
+        "SELECT Id, Recipient, Author, Contents, Region, Created FROM Message ORDER BY Id",
+        "INSERT {} INTO Message (Id, Recipient, Author, Contents, Region, Created) VALUES (?, ?, ?, ?, ?, ?)",
+    ),
+}
+
+class BulkError(Exception):
+    pass
+
+def chunked(items: Iterable[Any], size: int) -> Iterator[list[Any]]:
+    items = iter(items)
+    while chunk := list(itertools.islice(items, size)):
+        yield chunk
+
+def detect_format(path: str, format: str | None) -> str:
+    if format != None: return format
+    if path.endswith(".csv"): return "csv"
+    return "ndjson"
+
+def read_records(fp: TextIO, format: str) -> Iterator[dict[str, Any]]:
+    if format == "csv":
+        for record in csv.DictReader(fp):
+            # CSV has no null, empty fields stand for missing values.
+            yield { key: value for (key, value) in record.items() if value != "" }
+        return
+
+    for (line_number, line) in enumerate(fp, start=1):
+        if line.strip() == "": continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as err:
+            raise BulkError(f"Line {line_number}: {err}")
+        if not isinstance(record, dict):
+            raise BulkError(f"Line {line_number}: expected an object.")
+        yield record
+
+def write_records(fp: TextIO, format: str, fields: list[str], rows: Iterable[tuple]) -> int:
+    count = 0
+    if format == "csv":
+        out = csv.writer(fp)
+        out.writerow(fields)
+        for row in rows:
+            out.writerow(["" if value == None else value for value in row])
+            count += 1
+        return count
+
+    for row in rows:
+        fp.write(json.dumps(dict(zip(fields, row))) + "\n")
+        count += 1
+    return count
+
+def required(record: dict[str, Any], field: str) -> Any:
+    value = record.get(field)
+    if value == None or value == "":
+        raise BulkError(f"Missing {field} in {record}.")
+    return value
+
+def optional_int(record: dict[str, Any], field: str) -> int | None:
+    value = record.get(field)
+    if value == None: return None
+    try:
+        return int(value)
+    except ValueError:
+        raise BulkError(f"{field} must be an integer in {record}.")
+
+class Importer:
+    """
+    Turns chunks of records into rows for `Table.insert`.
+    """
+
+    hash_rounds: int
+
+    def __init__(self, hash_workers: int, hash_rounds: int):
+        self.hash_rounds = hash_rounds
+        self._executor = ThreadPoolExecutor(hash_workers, thread_name_prefix="bulk-hash")
+
+    def hash_password(self, password: str) -> str:
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(self.hash_rounds)).decode()
+
+    def users(self, records: list[dict[str, Any]]) -> list[tuple]:
+        hashes = [record.get("password_hash") for record in records]
+        unhashed = [i for (i, password_hash) in enumerate(hashes) if password_hash == None]
+        passwords = [required(records[i], "password") for i in unhashed]
+        for (i, password_hash) in zip(unhashed, self._executor.map(self.hash_password, passwords)):
+            hashes[i] = password_hash
+
+        return [(
+            required(record, "email"),
+            password_hash,
+            required(record, "firstname"),
+            required(record, "familyname"),
+            required(record, "gender"),
+            required(record, "city"),
+            required(record, "country"),
+        ) for (record, password_hash) in zip(records, hashes)]
+
+    def sessions(self, records: list[dict[str, Any]]) -> list[tuple]:
+        now = int(time.time())
+        rows = []
+        for record in records:
+            created = optional_int(record, "created") or now
+            last_seen = optional_int(record, "last_seen") or created
+            expires_at = optional_int(record, "expires_at") or last_seen + SESSION_LIFETIME
+            rows.append((required(record, "token"), required(record, "email"), created, last_seen, expires_at))
+        return rows
+
+    def messages(self, records: list[dict[str, Any]]) -> list[tuple]:
+        now = int(time.time())
+        return [(
+            optional_int(record, "id"),
+            required(record, "recipient"),
+            required(record, "author"),
+            required(record, "contents"),
+            record.get("region"),
+            optional_int(record, "created") or now,
+        ) for record in records]
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+def connect(path: str) -> sqlite3.Connection:
+    con = sqlite3.connect(path, isolation_level=None)
+    for pragma in BULK_PRAGMAS:
+        con.execute(pragma)
+    # Same schema the server would migrate to.
+    migrate(con, SESSION_LIFETIME)
+    return con
+
+def drop_indexes_and_triggers(con: sqlite3.Connection, table: str) -> list[str]:
+    """
+    Drops `table`'s secondary indexes and triggers, returns the statements recreating them.
+    """
+
+    # Automatic indexes (primary keys, UNIQUE) have no SQL and stay.
+    res = con.execute("SELECT type, name, sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL", (table,))
+    objects = res.fetchall()
+    for (type, name, _) in objects:
+        con.execute(f'DROP {type.upper()} "{name}"')
+    # Indexes first, the triggers may rely on them.
+    return [sql for (type, _, sql) in objects if type == "index"] + [sql for (type, _, sql) in objects if type == "trigger"]
+
+def catch_up_messages(con: sqlite3.Connection, last_id: int, min_id: int | None):
+    """
+    Does what the dropped Message triggers would have done for the imported rows.
+    """
+
+    if min_id != None and min_id <= last_id:
+        # Explicit ids mixed in with existing ones, the new rows can't be told apart.
+        con.execute("INSERT INTO MessageSearch (MessageSearch) VALUES ('rebuild')")
+        con.execute("UPDATE User SET WallVersion = WallVersion + 1 WHERE Email IN (SELECT Recipient FROM Message)")
+        return
+
+    con.execute("INSERT INTO MessageSearch (rowid, Contents) SELECT Id, Contents FROM Message WHERE Id > ?", (last_id,))
+    con.execute("UPDATE User SET WallVersion = WallVersion + 1 WHERE Email IN (SELECT Recipient FROM Message WHERE Id > ?)", (last_id,))
+
+def import_records(con: sqlite3.Connection, kind: str, records: Iterable[dict[str, Any]], importer: Importer, chunk_size: int, ignore_existing: bool) -> int:
+    table = TABLES[kind]
+    prepare: Callable[[list[dict[str, Any]]], list[tuple]] = getattr(importer, kind)
+    insert = table.insert.format("OR IGNORE" if ignore_existing else "")
+
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        if kind == "messages":
+            (last_id,) = con.execute("SELECT COALESCE(MAX(Id), 0) FROM Message").fetchone()
+            min_id = None
+
+        recreate = drop_indexes_and_triggers(con, table.name)
+
+        count = 0
+        start = time.perf_counter()
+        for chunk in chunked(records, chunk_size):
+            rows = prepare(chunk)
+            con.executemany(insert, rows)
+
+            if kind == "messages":
+                ids = [row[0] for row in rows if row[0] != None]
+                if ids:
+                    min_id = min(ids) if min_id == None else min(min_id, *ids)
+
+            previous = count
+            count += len(rows)
+            if count // PROGRESS_INTERVAL != previous // PROGRESS_INTERVAL:
+                print(f"Imported {count} {kind} ({count / (time.perf_counter() - start):.0f}/s).", file=sys.stderr)
+
+        print(f"Recreating {len(recreate)} indexes and triggers.", file=sys.stderr)
+        for sql in recreate:
+            con.execute(sql)
+        if kind == "messages":
+            catch_up_messages(con, last_id, min_id)
+
+        con.execute("COMMIT")
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+
+    return count
+
+def export_records(con: sqlite3.Connection, kind: str) -> Iterator[tuple]:
+    res = con.execute(TABLES[kind].select)
+    while rows := res.fetchmany(CHUNK_SIZE):
+        yield from rows
+
+def open_file(path: str, mode: str) -> ContextManager[TextIO]:
+    if path == "-":
+        # Left open, they aren't ours.
+        return contextlib.nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    return open(path, mode, newline="", encoding="utf-8")
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(prog="twidder-bulk", description="Bulk import and export of Twidder data.")
+    parser.add_argument("--database", default=DATABASE_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import")
+    import_parser.add_argument("kind", choices=TABLES.keys())
+    import_parser.add_argument("file", help="Path, or - for stdin.")
+    import_parser.add_argument("--format", choices=["ndjson", "csv"], help="Defaults to csv for .csv files, ndjson otherwise.")
+    import_parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    import_parser.add_argument("--ignore-existing", action="store_true", help="Skip rows that already exist instead of failing.")
+    import_parser.add_argument("--hash-workers", type=int, default=os.cpu_count() or 1)
+    import_parser.add_argument("--hash-rounds", type=int, default=12, help="bcrypt cost for plaintext passwords, lower it for test data.")
+
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("kind", choices=TABLES.keys())
+    export_parser.add_argument("file", help="Path, or - for stdout.")
+    export_parser.add_argument("--format", choices=["ndjson", "csv"], help="Defaults to csv for .csv files, ndjson otherwise.")
+
+    args = parser.parse_args(argv)
+    format = detect_format(args.file, args.format)
+    con = connect(args.database)
+    start = time.perf_counter()
+
+    try:
+        if args.command == "import":
+            importer = Importer(args.hash_workers, args.hash_rounds)
+            try:
+                with open_file(args.file, "r") as fp:
+                    count = import_records(con, args.kind, read_records(fp, format), importer, args.chunk_size, args.ignore_existing)
+            finally:
+                importer.shutdown()
+            print(f"Imported {count} {args.kind} in {time.perf_counter() - start:.1f}s.", file=sys.stderr)
+        else:
+            with open_file(args.file, "w") as fp:
+                count = write_records(fp, format, TABLES[args.kind].fields, export_records(con, args.kind))
+            print(f"Exported {count} {args.kind} in {time.perf_counter() - start:.1f}s.", file=sys.stderr)
+    except BulkError as err:
+        print(f"Error: {err}", file=sys.stderr)
+        sys.exit(1)
+    except sqlite3.IntegrityError as err:
+        print(f"Error: {err}, nothing was imported. --ignore-existing skips rows that already exist.", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        con.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded cache with least-recently-used eviction and a
+    per-entry time to live.
+    """
+
+    max_size: int
+    ttl: float
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    # Bumped by every invalidation, see `put`.
+    generation: int = 0
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any, ttl: float | None = None, generation: int | None = None):
+        """
+        Pass the `generation` read before loading `value` to drop the write if an
+        invalidation happened in the meantime, so a slow reader can't resurrect a
+        deleted entry.
+        """
+
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0,
+        }
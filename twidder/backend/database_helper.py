@@ -1,9 +1,34 @@
 import os
 import sqlite3
+import time
 from .lib import BadRequestError, NotFoundError, SignUpData, UnauthorizedError, hash_password
+from .cache import LRUCache
+from .metrics import cache_lookups, stats_gauges, timed_query
+from .pool import SESSION_LIFETIME, pool
+from .writer import writer
+
+# Token -> email, shared by `protected` and the websocket login.
+session_cache = LRUCache(
+    int(os.environ.get("TWIDDER_SESSION_CACHE_SIZE", 10000)),
+    float(os.environ.get("TWIDDER_SESSION_CACHE_TTL", 300)),
+)
+stats_gauges("twidder_session_cache", "Session cache", session_cache.stats)
+
+# Email -> User, or NO_USER for emails known not to exist.
+user_cache = LRUCache(
+    int(os.environ.get("TWIDDER_USER_CACHE_SIZE", 10000)),
+    float(os.environ.get("TWIDDER_USER_CACHE_TTL", 300)),
+)
+stats_gauges("twidder_user_cache", "User cache", user_cache.stats)
+# Kept short, a sign up in another worker only reaches this one through the bus.
+USER_CACHE_NEGATIVE_TTL = float(os.environ.get("TWIDDER_USER_CACHE_NEGATIVE_TTL", 30))
+NO_USER = object()
+
+# LastSeen (and with it ExpiresAt) is written at most this often per session.
+SESSION_TOUCH_INTERVAL = int(os.environ.get("TWIDDER_SESSION_TOUCH_INTERVAL", 300))
 
 def get_conn():
-    return sqlite3.connect("database.db")
+    return pool.connection()
 
 # if os.path.exists("database.db"):
 #     os.remove("database.db")
@@ -19,14 +44,17 @@ class User:
     gender: str
     city: str
     country: str
+    # Bumped on every profile change, used for ETags.
+    profile_version: int
 
-    def __init__(self, email, firstname, familyname, gender, city, country):
+    def __init__(self, email, firstname, familyname, gender, city, country, profile_version = 0):
         self.email = email
         self.firstname = firstname
         self.familyname = familyname
         self.gender = gender
         self.city = city
         self.country = country
+        self.profile_version = profile_version
 
     def as_dict(self):
         return {
@@ -39,28 +67,109 @@ class User:
         }
 
 class Message:
+    id: int
     author: str
     contents: str
     region: str | None
+    created: int
 
-    def __init__(self, author, contents, region):
+    def __init__(self, id, author, contents, region, created):
+        self.id = id
         self.author = author
         self.contents = contents
         self.region = region
+        self.created = created
 
     def as_dict(self):
         return {
+            "id": self.id,
             "author": self.author,
             "contents": self.contents,
             "region": self.region,
+            "created": self.created,
         }
 
+def load_user(email: str) -> User | None:
+    """
+    Cached, returns None for unknown emails.
+    """
+
+    user = user_cache.get(email)
+    if user != None:
+        cache_lookups.inc(cache="user", outcome="hit")
+        return None if user is NO_USER else user
+    cache_lookups.inc(cache="user", outcome="miss")
+
+    generation = user_cache.generation
+    user = select_user(email)
+    if user is None:
+        user_cache.put(email, NO_USER, ttl=USER_CACHE_NEGATIVE_TTL, generation=generation)
+        return None
+
+    user_cache.put(email, user, generation=generation)
+    return user
+
+@timed_query
+def select_user(email: str) -> User | None:
+    with get_conn() as con:
+        res = con.execute("SELECT Email, FirstName, FamilyName, Gender, City, Country, ProfileVersion FROM User WHERE Email = ?", (email,))
+        res = res.fetchone()
+        return None if res is None else User(*res)
+
+def load_users(emails: list[str]) -> dict[str, User]:
+    """
+    Like `load_user` for many emails, the uncached ones are fetched with a
+    single query. Unknown emails are left out.
+    """
+
+    users = {}
+    missing = []
+    for email in emails:
+        user = user_cache.get(email)
+        if user is NO_USER: continue
+        if user != None:
+            users[email] = user
+        else:
+            missing.append(email)
+    cache_lookups.inc(len(emails) - len(missing), cache="user", outcome="hit")
+    if not missing: return users
+    cache_lookups.inc(len(missing), cache="user", outcome="miss")
+
+    generation = user_cache.generation
+    for user in select_users(missing):
+        users[user.email] = user
+        user_cache.put(user.email, user, generation=generation)
+    for email in missing:
+        if email not in users:
+            user_cache.put(email, NO_USER, ttl=USER_CACHE_NEGATIVE_TTL, generation=generation)
+    return users
+
+@timed_query
+def select_users(emails: list[str]) -> list[User]:
+    with get_conn() as con:
+        placeholders = ", ".join("?" * len(emails))
+        res = con.execute(f"SELECT Email, FirstName, FamilyName, Gender, City, Country, ProfileVersion FROM User WHERE Email IN ({placeholders})", emails)
+        return [User(*row) for row in res.fetchall()]
+
 def check_user_exists(email: str) -> bool:
+    return load_user(email) != None
+
+def get_existing_users(emails: list[str]) -> set[str]:
+    return set(load_users(emails).keys())
+
+@timed_query
+def get_wall_version(email: str) -> int | None:
+    """
+    Bumped whenever a message on the wall is added, changed or removed, None
+    for unknown users. Not cached, walls change too often.
+    """
+
     with get_conn() as con:
-        res = con.execute("SELECT 1 FROM User WHERE Email = ?", (email,))
+        res = con.execute("SELECT WallVersion FROM User WHERE Email = ?", (email,))
         res = res.fetchone()
-        return res != None
+        return None if res is None else res[0]
 
+@timed_query
 def get_password_hash(email: str) -> str | None:
     with get_conn() as con:
         res = con.execute("SELECT PasswordHash FROM User WHERE Email = ?", (email,))
@@ -72,67 +181,261 @@ def get_password_hash(email: str) -> str | None:
         return password_hash
 
 def get_user_by_email(email: str) -> User:
-    with get_conn() as con:
-        res = con.execute("SELECT Email, FirstName, FamilyName, Gender, City, Country FROM User WHERE Email = ?", (email,))
-
-        res = res.fetchone()
-        if res is None: raise NotFoundError("No such user.")
-
-        (email, firstname, familyname, gender, city, country) = res
-        return User(email, firstname, familyname, gender, city, country)
+    user = load_user(email)
+    if user is None: raise NotFoundError("No such user.")
+    return user
 
 def insert_user(data: SignUpData):
+    # Hash before borrowing a connection, bcrypt is slow.
+    insert_user_row(data, hash_password(data.password))
+
+@timed_query
+def insert_user_row(data: SignUpData, password_hash: str):
     with get_conn() as con:
         con.execute("INSERT INTO User(Email, PasswordHash, FirstName, FamilyName, Gender, City, Country) VALUES (?, ?, ?, ?, ?, ?, ?)", (
             data.email,
-            hash_password(data.password),
+            password_hash,
             data.firstname,
             data.familyname,
             data.gender,
             data.city,
             data.country
         ))
+    user_cache.invalidate(data.email)
 
+@timed_query
 def change_password(email: str, new_password: str):
     with get_conn() as con:
         con.execute("UPDATE User SET PasswordHash = ? WHERE Email = ?", (new_password, email,))
+    user_cache.invalidate(email)
 
+def normalize_token(token: str) -> str:
+    return str(token).strip()
+
+@timed_query
 def insert_session(token: str, email: str):
-    with get_conn() as con:
-        con.execute("INSERT INTO Session VALUES (?, ?)", (str(token).strip(), email))
+    token = normalize_token(token)
+    now = int(time.time())
+    # Committed together with other concurrent writes.
+    writer.run(lambda con: con.execute(
+        "INSERT INTO Session (Token, Email, Created, LastSeen, ExpiresAt) VALUES (?, ?, ?, ?, ?)",
+        (token, email, now, now, now + SESSION_LIFETIME),
+    ))
+    session_cache.put(token, email)
 
+@timed_query
 def delete_session(token: str):
+    token = normalize_token(token)
     with get_conn() as con:
         con.execute("DELETE FROM Session WHERE Token = ?", (token,))
+    session_cache.invalidate(token)
 
-def check_session(token: str):
+@timed_query
+def delete_other_sessions(email: str, keep_token: str) -> list[str]:
+    """
+    Deletes every session of `email` except `keep_token`, returns the deleted tokens.
+    """
+
+    keep_token = normalize_token(keep_token)
     with get_conn() as con:
-        res = con.execute("SELECT 1 FROM Session WHERE Token = ?", (str(token).strip(),))
-        res = res.fetchone()
-        return res != None
+        res = con.execute("DELETE FROM Session WHERE Email = ? AND Token != ? RETURNING Token", (email, keep_token))
+        tokens = [token for (token,) in res.fetchall()]
+
+    for token in tokens:
+        session_cache.invalidate(token)
+    return tokens
+
+@timed_query
+def delete_expired_sessions(limit: int) -> int:
+    """
+    Deletes at most `limit` expired sessions, returns how many were deleted.
+    """
+
+    with get_conn() as con:
+        res = con.execute(
+            "DELETE FROM Session WHERE Token IN (SELECT Token FROM Session WHERE ExpiresAt <= ? LIMIT ?)",
+            (int(time.time()), limit),
+        )
+        return res.rowcount
+
+def check_session(token: str):
+    return try_get_email_from_session(token) != None
 
 def try_get_email_from_session(token: str) -> str | None:
+    token = normalize_token(token)
+    email = session_cache.get(token)
+    if email != None:
+        cache_lookups.inc(cache="session", outcome="hit")
+        return email
+    cache_lookups.inc(cache="session", outcome="miss")
+
+    generation = session_cache.generation
+    now = int(time.time())
+    res = select_session(token, now)
+    if res is None: return None
+
+    (email, expires_at) = res
+    session_cache.put(token, email, ttl=min(session_cache.ttl, expires_at - now), generation=generation)
+    return email
+
+@timed_query
+def select_session(token: str, now: int) -> tuple[str, int] | None:
+    """
+    Returns the session's (email, expiry), extending it if it wasn't for a while.
+    """
+
     with get_conn() as con:
-        res = con.execute("SELECT Email FROM Session WHERE Token = ?", (str(token).strip(),))
+        res = con.execute("SELECT Email, LastSeen, ExpiresAt FROM Session WHERE Token = ? AND ExpiresAt > ?", (token, now))
 
         res = res.fetchone()
         if res is None: return None
 
-        (email,) = res
-        return email
+        (email, last_seen, expires_at) = res
+
+        # Only written on cache misses, and then at most once per touch interval.
+        if now - last_seen >= SESSION_TOUCH_INTERVAL:
+            expires_at = now + SESSION_LIFETIME
+            con.execute("UPDATE Session SET LastSeen = ?, ExpiresAt = ? WHERE Token = ?", (now, expires_at, token))
+
+        return (email, expires_at)
 
 def get_email_from_session(token: str) -> str | None:
     email = try_get_email_from_session(token)
     if email == None: raise Exception("Couldn't get email from token.")
     return email
 
-def post_message(author: str, contents: str, recipient: str, region: str | None):
+@timed_query
+def post_message(author: str, contents: str, recipient: str, region: str | None) -> Message:
+    def insert(con: sqlite3.Connection) -> Message:
+        res = con.execute("INSERT INTO Message (Recipient, Author, Contents, Region) VALUES (?, ?, ?, ?) RETURNING Id, Created", (recipient, author, contents, region))
+        (id, created) = res.fetchone()
+        return Message(id, author, contents, region, created)
+
+    # Committed together with other concurrent writes, returns once durable.
+    return writer.run(insert)
+
+@timed_query
+def post_messages(author: str, contents: str, recipients: list[str], region: str | None) -> list[Message]:
+    """
+    Posts the same message to every recipient's wall in one transaction,
+    returns the messages in the order of `recipients`.
+    """
+
+    def insert(con: sqlite3.Connection) -> list[Message]:
+        # The writer holds the write lock, so the new rows are exactly the ones after this id.
+        (last_id,) = con.execute("SELECT COALESCE(MAX(Id), 0) FROM Message").fetchone()
+        con.executemany("INSERT INTO Message (Recipient, Author, Contents, Region) VALUES (?, ?, ?, ?)", [(recipient, author, contents, region) for recipient in recipients])
+        res = con.execute("SELECT Id, Created FROM Message WHERE Id > ? ORDER BY Id", (last_id,))
+        return [Message(id, author, contents, region, created) for (id, created) in res.fetchall()]
+
+    return writer.run(insert)
+
+@timed_query
+def set_message_regions(regions: list[tuple[str | None, int]]):
+    """
+    Takes (region, message id) pairs.
+    """
+
     with get_conn() as con:
-        con.execute("INSERT INTO Message VALUES (?, ?, ?, ?)", (recipient, author, contents, region))
+        con.executemany("UPDATE Message SET Region = ? WHERE Id = ?", regions)
+
+def select_user_messages(con: sqlite3.Connection, email: str, before: int | None, since: int | None, limit: int) -> sqlite3.Cursor:
+    if since != None:
+        return con.execute("SELECT Id, Author, Contents, Region, Created FROM Message WHERE Recipient = ? AND Id > ? ORDER BY Id ASC LIMIT ?", (email, since, limit))
+    if before == None:
+        return con.execute("SELECT Id, Author, Contents, Region, Created FROM Message WHERE Recipient = ? ORDER BY Id DESC LIMIT ?", (email, limit))
+    return con.execute("SELECT Id, Author, Contents, Region, Created FROM Message WHERE Recipient = ? AND Id < ? ORDER BY Id DESC LIMIT ?", (email, before, limit))
+
+@timed_query
+def get_user_messages(email: str, before: int | None, limit: int, since: int | None = None) -> list[Message]:
+    """
+    Newest first, `before` is the id of the last message of the previous page.
+
+    With `since` only messages newer than that id are returned, oldest first,
+    so a client can catch up on what it missed by repeating the request with
+    the id of the last message it got.
+    """
 
-def get_user_messages(email: str):
     with get_conn() as con:
-        res = con.execute("SELECT Author, Contents, Region FROM Message WHERE Recipient = ?", (email,))
+        res = select_user_messages(con, email, before, since, limit)
         res = res.fetchall()
 
-        return [Message(author, contents, region) for (author, contents, region) in res]
\ No newline at end of file
+        return [Message(id, author, contents, region, created) for (id, author, contents, region, created) in res]
+
+def iter_user_messages(email: str, before: int | None, limit: int, since: int | None = None, chunk_size: int = 256):
+    """
+    Streaming variant of `get_user_messages`, yields lists of message dicts built
+    straight from the rows, at most `chunk_size` at a time.
+
+    Every chunk is its own keyset query on a connection borrowed just for it, so
+    a slow client never holds a pooled connection or an old read snapshot.
+    """
+
+    remaining = limit
+    while remaining != 0:
+        size = chunk_size if remaining < 0 else min(chunk_size, remaining)
+        with get_conn() as con:
+            rows = select_user_messages(con, email, before, since, size).fetchall()
+        if not rows: break
+
+        yield [
+            { "id": id, "author": author, "contents": contents, "region": region, "created": created }
+            for (id, author, contents, region, created) in rows
+        ]
+
+        if len(rows) < size: break
+        if remaining > 0: remaining -= len(rows)
+        # Continue after the last row, in the direction of the query.
+        if since != None:
+            since = rows[-1][0]
+        else:
+            before = rows[-1][0]
+
+def to_match_query(query: str) -> str:
+    """
+    Turns user input into an FTS5 query matching all of its words, a trailing *
+    on a word makes it a prefix search.
+    """
+
+    terms = []
+    for word in query.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if len(word) == 0: continue
+        terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return " ".join(terms)
+
+@timed_query
+def search_messages(query: str, author: str | None, recipient: str | None, region: str | None, limit: int, offset: int) -> list[dict]:
+    """
+    Best matches first.
+    """
+
+    match = to_match_query(query)
+    if len(match) == 0: return []
+
+    sql = "SELECT m.Id, m.Recipient, m.Author, m.Contents, m.Region, m.Created FROM MessageSearch s JOIN Message m ON m.Id = s.rowid WHERE MessageSearch MATCH ?"
+    params: list = [match]
+    for (column, value) in (("Author", author), ("Recipient", recipient), ("Region", region)):
+        if value != None:
+            sql += f" AND m.{column} = ?"
+            params.append(value)
+    sql += " ORDER BY s.rank LIMIT ? OFFSET ?"
+    params += [limit, offset]
+
+    with get_conn() as con:
+        res = con.execute(sql, params)
+        return [
+            { "id": id, "recipient": recipient, "author": author, "contents": contents, "region": region, "created": created }
+            for (id, recipient, author, contents, region, created) in res.fetchall()
+        ]
+
+def rebuild_search_index():
+    """
+    Rebuilds the full-text index from the Message table, e.g. after bulk loading
+    with the triggers disabled.
+    """
+
+    with get_conn() as con:
+        con.execute("INSERT INTO MessageSearch (MessageSearch) VALUES ('rebuild')")
+        con.execute("INSERT INTO MessageSearch (MessageSearch) VALUES ('optimize')")
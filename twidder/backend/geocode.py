@@ -0,0 +1,322 @@
+import csv
+import hashlib
+import math
+import os
+import threading
+import time
+import requests
+from .cache import LRUCache
+from .metrics import gauge, geocode_latency
+from .pool import ConnectionPool
+
+REGIONS_FILE = os.environ.get("TWIDDER_REGIONS_FILE", os.path.join(os.path.dirname(__file__), "regions.csv"))
+# Points further than this from every known place resolve to no region. The bundled gazetteer
+# only lists larger cities, a wider cutoff would label rural points with a city far away.
+MAX_DISTANCE_KM = float(os.environ.get("TWIDDER_REGION_MAX_DISTANCE_KM", 50))
+# Set to 1 to ask geocode.xyz about places the gazetteer can't resolve.
+HTTP_FALLBACK = os.environ.get("TWIDDER_GEOCODE_HTTP_FALLBACK", "0") == "1"
+HTTP_TIMEOUT = float(os.environ.get("TWIDDER_GEOCODE_HTTP_TIMEOUT", 5))
+
+# Decimal places coordinates are rounded to before caching, 2 is roughly 1 km.
+CACHE_PRECISION = int(os.environ.get("TWIDDER_GEOCODE_CACHE_PRECISION", 2))
+CACHE_SIZE = int(os.environ.get("TWIDDER_GEOCODE_CACHE_SIZE", 10000))
+CACHE_PATH = os.environ.get("TWIDDER_GEOCODE_CACHE", "geocode_cache.db")
+# Seconds a "no region" result is trusted, the gazetteer or fallback may know the place later.
+CACHE_NEGATIVE_TTL = float(os.environ.get("TWIDDER_GEOCODE_CACHE_NEGATIVE_TTL", 24 * 60 * 60))
+
+EARTH_RADIUS_KM = 6371.0
+
+class GeocodeError(Exception):
+    pass
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+class RegionResolver:
+    """
+    Maps a coordinate to a region name.
+
+    `resolve` returns None when the coordinate has no known region and raises
+    GeocodeError when the lookup itself failed and may be retried.
+    """
+
+    def resolve(self, lat: float, lon: float) -> str | None:
+        raise NotImplementedError
+
+    def fingerprint(self) -> str:
+        """
+        Changes whenever the resolver could give different answers, cached
+        results from another fingerprint are ignored.
+        """
+
+        return type(self).__name__
+
+class OfflineRegionResolver(RegionResolver):
+    """
+    Nearest-place lookup over a local gazetteer of (region, lat, lon) rows.
+
+    Places are bucketed into a grid of `cell_size` degree cells, a lookup only
+    visits the cells around the query point that can be within
+    `max_distance_km`. Longitude cells shrink towards the poles, so more of
+    them are visited there, never more than once around the globe.
+    """
+
+    path: str
+    max_distance_km: float
+    cell_size: float
+
+    def __init__(self, path: str, max_distance_km: float, cell_size: float = 1.0):
+        self.path = path
+        self.max_distance_km = max_distance_km
+        self.cell_size = cell_size
+
+        self._grid: dict[tuple[int, int], list[tuple[float, float, str]]] | None = None
+        self._fingerprint: str | None = None
+        self._lock = threading.Lock()
+
+    def fingerprint(self) -> str:
+        with self._lock:
+            if self._fingerprint is None:
+                with open(self.path, "rb") as fp:
+                    digest = hashlib.sha256(fp.read()).hexdigest()[:16]
+                self._fingerprint = f"offline:{digest}:{self.max_distance_km}"
+            return self._fingerprint
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return (math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def _load(self) -> dict[tuple[int, int], list[tuple[float, float, str]]]:
+        with self._lock:
+            if self._grid is None:
+                grid = {}
+                with open(self.path, newline='', encoding='utf-8') as fp:
+                    for row in csv.DictReader(fp):
+                        lat, lon = float(row['lat']), float(row['lon'])
+                        grid.setdefault(self._cell(lat, lon), []).append((lat, lon, row['region']))
+                self._grid = grid
+            return self._grid
+
+    def resolve(self, lat: float, lon: float) -> str | None:
+        grid = self._load()
+        cell_lat, cell_lon = self._cell(lat, lon)
+
+        # A degree of latitude is ~111 km, a degree of longitude ~111 km * cos(latitude).
+        max_lat_degrees = self.max_distance_km / 111.0
+        lat_cells = math.ceil(max_lat_degrees / self.cell_size)
+
+        wrap = round(360 / self.cell_size)
+        # Longitude degrees are shortest on the side of the search area closest to the pole.
+        edge_lat = abs(lat) + max_lat_degrees
+        if edge_lat >= 90:
+            lon_cells = wrap
+        else:
+            lon_cells = math.ceil(max_lat_degrees / math.cos(math.radians(edge_lat)) / self.cell_size)
+
+        if 2 * lon_cells + 1 >= wrap:
+            lon_range = range(-(wrap // 2), wrap - wrap // 2)
+        else:
+            lon_range = range(cell_lon - lon_cells, cell_lon + lon_cells + 1)
+
+        best, best_distance = None, self.max_distance_km
+        for grid_lat in range(cell_lat - lat_cells, cell_lat + lat_cells + 1):
+            for grid_lon in lon_range:
+                grid_lon_wrapped = (grid_lon + wrap // 2) % wrap - wrap // 2
+                for (p_lat, p_lon, region) in grid.get((grid_lat, grid_lon_wrapped), ()):
+                    distance = distance_km(lat, lon, p_lat, p_lon)
+                    if distance <= best_distance:
+                        best, best_distance = region, distance
+
+        return best
+
+class GeocodeXyzResolver(RegionResolver):
+    """
+    Looks the region up through the geocode.xyz HTTP API.
+    """
+
+    timeout: float
+    min_confidence: float
+
+    def __init__(self, timeout: float, min_confidence: float = 0.5):
+        self.timeout = timeout
+        self.min_confidence = min_confidence
+
+    def fingerprint(self) -> str:
+        return f"geocode.xyz:{self.min_confidence}"
+
+    def resolve(self, lat: float, lon: float) -> str | None:
+        try:
+            resp = requests.get(f"https://geocode.xyz/{lat},{lon}?json=1", timeout=self.timeout)
+            resp = resp.json()
+        except (requests.RequestException, ValueError) as err:
+            raise GeocodeError(f"geocode.xyz lookup failed: {err}")
+
+        standard = resp.get('standard')
+        if not isinstance(standard, dict):
+            raise GeocodeError(f"geocode.xyz lookup failed: {resp.get('error', resp)}")
+
+        if float(standard.get('confidence', 0)) > self.min_confidence:
+            return standard.get('region')
+        return None
+
+class FallbackRegionResolver(RegionResolver):
+    """
+    Asks each resolver in turn and returns the first region found.
+    """
+
+    resolvers: list[RegionResolver]
+
+    def __init__(self, resolvers: list[RegionResolver]):
+        self.resolvers = resolvers
+
+    def fingerprint(self) -> str:
+        return "+".join(resolver.fingerprint() for resolver in self.resolvers)
+
+    def resolve(self, lat: float, lon: float) -> str | None:
+        for resolver in self.resolvers:
+            region = resolver.resolve(lat, lon)
+            if region != None:
+                return region
+        return None
+
+# Marks a cached "no region" result in the memory tier.
+NO_REGION = object()
+
+class CachedRegionResolver(RegionResolver):
+    """
+    Caches another resolver's results by coordinates rounded to `precision`
+    decimals, first in an in-memory LRU and then in a SQLite file that survives
+    restarts. "No region" results are cached for `negative_ttl` seconds, failed
+    lookups are not.
+
+    Disk rows remember the resolver's fingerprint, rows written with another
+    gazetteer or fallback setting are resolved again.
+    """
+
+    resolver: RegionResolver
+    precision: int
+    negative_ttl: float
+
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    def __init__(self, resolver: RegionResolver, precision: int, size: int, path: str | None, negative_ttl: float):
+        self.resolver = resolver
+        self.precision = precision
+        self.negative_ttl = negative_ttl
+
+        self._memory = LRUCache(size, float('inf'))
+        self._disk = ConnectionPool(path, 2, 10, self._create_table) if path != None else None
+        self._lock = threading.Lock()
+
+    def _create_table(self, con):
+        columns = [row[1] for row in con.execute("PRAGMA table_info(RegionCache)")]
+        if columns and "Fingerprint" not in columns:
+            # Written before rows were fingerprinted, nothing in it can be trusted.
+            con.execute("DROP TABLE RegionCache")
+
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS RegionCache (
+                Precision INTEGER NOT NULL,
+                Lat INTEGER NOT NULL,
+                Lon INTEGER NOT NULL,
+                Region TEXT,
+                Fingerprint TEXT NOT NULL,
+                Created REAL NOT NULL,
+                PRIMARY KEY (Precision, Lat, Lon)
+            ) WITHOUT ROWID
+        """)
+        con.commit()
+
+    def _key(self, lat: float, lon: float) -> tuple[int, int, int]:
+        scale = 10 ** self.precision
+        return (self.precision, round(lat * scale), round(lon * scale))
+
+    def _disk_get(self, key: tuple[int, int, int]):
+        with self._disk.connection() as con:
+            res = con.execute("SELECT Region, Fingerprint, Created FROM RegionCache WHERE Precision = ? AND Lat = ? AND Lon = ?", key)
+            res = res.fetchone()
+            if res is None: return None
+
+            (region, fingerprint, created) = res
+            if fingerprint != self.resolver.fingerprint(): return None
+            if region is None:
+                if time.time() - created >= self.negative_ttl: return None
+                return NO_REGION
+            return region
+
+    def _disk_put(self, key: tuple[int, int, int], region: str | None):
+        with self._disk.connection() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO RegionCache (Precision, Lat, Lon, Region, Fingerprint, Created) VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, region, self.resolver.fingerprint(), time.time()),
+            )
+
+    def resolve(self, lat: float, lon: float) -> str | None:
+        key = self._key(lat, lon)
+
+        cached = self._memory.get(key)
+        if cached != None:
+            with self._lock: self.memory_hits += 1
+            return None if cached is NO_REGION else cached
+
+        if self._disk != None:
+            cached = self._disk_get(key)
+            if cached != None:
+                with self._lock: self.disk_hits += 1
+                self._memory.put(key, cached, ttl=self.negative_ttl if cached is NO_REGION else None)
+                return None if cached is NO_REGION else cached
+
+        with self._lock: self.misses += 1
+        scale = 10 ** self.precision
+        region = self.resolver.resolve(key[1] / scale, key[2] / scale)
+
+        if region is None:
+            self._memory.put(key, NO_REGION, ttl=self.negative_ttl)
+        else:
+            self._memory.put(key, region)
+        if self._disk != None:
+            self._disk_put(key, region)
+        return region
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "precision": self.precision,
+                "memory_size": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+def create_default_resolver() -> RegionResolver:
+    resolver = OfflineRegionResolver(REGIONS_FILE, MAX_DISTANCE_KM)
+    if HTTP_FALLBACK:
+        resolver = FallbackRegionResolver([resolver, GeocodeXyzResolver(HTTP_TIMEOUT)])
+    return CachedRegionResolver(resolver, CACHE_PRECISION, CACHE_SIZE, CACHE_PATH or None, CACHE_NEGATIVE_TTL)
+
+region_resolver: RegionResolver = create_default_resolver()
+
+def set_region_resolver(resolver: RegionResolver):
+    global region_resolver
+    region_resolver = resolver
+
+def resolve_region(lat: float | None, lon: float | None) -> str | None:
+    if lat == None or lon == None:
+        return None
+
+    start = time.perf_counter()
+    try:
+        return region_resolver.resolve(lat, lon)
+    finally:
+        geocode_latency.observe(time.perf_counter() - start)
+
+def region_cache_stats() -> list[tuple[dict[str, str], float]]:
+    if not isinstance(region_resolver, CachedRegionResolver):
+        return []
+    stats = region_resolver.stats()
+    return [({ "result": key }, stats[key]) for key in ("memory_hits", "disk_hits", "misses")]
+
+gauge("twidder_region_cache_lookups", "Region cache lookups by result.", region_cache_stats)
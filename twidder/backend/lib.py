@@ -1,9 +1,13 @@
+import json
+import math
 import random
 import re
 import string
-from typing import Any
-from flask import jsonify, request
+import zlib
+from typing import Any, Iterable
+from flask import Response, g, jsonify, request, stream_with_context
 from . import database_helper
+from .password_pool import PasswordPoolFullError, password_pool
 import bcrypt
 
 
@@ -35,9 +39,20 @@ class ForbiddenError(Exception):
 class NotFoundError(Exception):
     pass
 
+class TooManyRequestsError(Exception):
+    # Seconds until the client may try again.
+    retry_after: float
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
 class InternalServerError(Exception):
     pass
 
+class ServiceUnavailableError(Exception):
+    pass
+
 def missing(field: str):
     return BadRequestError(f"Missing {field}.")
 
@@ -132,8 +147,114 @@ class PostMessageData:
         self.lat = data['coords']['lat']
         self.lon = data['coords']['lon']
 
+MAX_RECIPIENTS = 100
+
+class PostMessagesData:
+    message: str
+    # Deduplicated, in the order given. Not validated, bad ones are reported per recipient.
+    recipients: list[str]
+    lat: float | None
+    lon: float | None
+
+    def __init__(self, data: dict[str, Any] | None):
+        if data == None: return
+        if not isinstance(data.get('message'), str): raise missing("Message")
+        if len(data.get('message')) == 0: raise BadRequestError("Message is empty.")
+        if not isinstance(data.get('emails'), list): raise missing("Emails")
+        if len(data.get('emails')) == 0: raise BadRequestError("Emails is empty.")
+        if not all(isinstance(email, str) for email in data['emails']): raise BadRequestError("Emails must be strings.")
+
+        self.message = data['message']
+        self.recipients = list(dict.fromkeys(data['emails']))
+        if len(self.recipients) > MAX_RECIPIENTS: raise BadRequestError(f"At most {MAX_RECIPIENTS} recipients.")
+
+        coords = data.get('coords')
+        if coords == None:
+            self.lat = self.lon = None
+        elif not isinstance(coords, dict) or not isinstance(coords.get('lat'), (int, float)) or not isinstance(coords.get('lon'), (int, float)):
+            raise missing("coords object need lat and lon fields.")
+        else:
+            self.lat = coords['lat']
+            self.lon = coords['lon']
+
+MAX_PRESENCE_EMAILS = 500
+
+class PresenceData:
+    # Deduplicated, in the order given.
+    emails: list[str]
+
+    def __init__(self, data: dict[str, Any] | None):
+        if data == None: return
+        if not isinstance(data.get('emails'), list): raise missing("Emails")
+        if not all(isinstance(email, str) for email in data['emails']): raise BadRequestError("Emails must be strings.")
+
+        self.emails = list(dict.fromkeys(data['emails']))
+        if len(self.emails) > MAX_PRESENCE_EMAILS: raise BadRequestError(f"At most {MAX_PRESENCE_EMAILS} emails.")
+
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 200
+# FTS5 ranks and skips every row before the offset, deeper pages need a narrower query.
+MAX_SEARCH_OFFSET = 1000
+
+def parse_int_arg(data: dict[str, Any], field: str) -> int | None:
+    if data.get(field) == None: return None
+    try:
+        value = int(data[field])
+    except ValueError:
+        raise BadRequestError(f"{field} must be an integer.")
+    if value < 0: raise BadRequestError(f"{field} must not be negative.")
+    return value
+
+class PaginationData:
+    before: int | None
+    since: int | None
+    # -1 means no limit.
+    limit: int
+    stream: bool
+
+    def __init__(self, data: dict[str, Any]):
+        self.before = parse_int_arg(data, 'before')
+        self.since = parse_int_arg(data, 'since')
+        if self.before != None and self.since != None: raise BadRequestError("Only one of before and since may be given.")
+        self.stream = data.get('stream') in ('1', 'true')
+
+        limit = parse_int_arg(data, 'limit')
+        if self.stream:
+            # Streamed responses have bounded memory, so the whole wall may be requested.
+            self.limit = -1 if limit == None else limit
+        else:
+            self.limit = MESSAGE_PAGE_SIZE if limit == None else min(limit, MAX_MESSAGE_PAGE_SIZE)
+
+class SearchData:
+    query: str
+    author: str | None
+    recipient: str | None
+    region: str | None
+    limit: int
+    offset: int
+
+    def __init__(self, data: dict[str, Any]):
+        if not isinstance(data.get('q'), str): raise missing("Search query")
+        if len(data.get('q').strip()) == 0: raise BadRequestError("Search query is empty.")
+
+        self.query = data['q']
+        self.author = data.get('author') or None
+        self.recipient = data.get('recipient') or None
+        self.region = data.get('region') or None
+
+        limit = parse_int_arg(data, 'limit')
+        self.limit = MESSAGE_PAGE_SIZE if limit == None else min(limit, MAX_MESSAGE_PAGE_SIZE)
+        self.offset = parse_int_arg(data, 'offset') or 0
+        if self.offset > MAX_SEARCH_OFFSET: raise BadRequestError(f"offset must be at most {MAX_SEARCH_OFFSET}.")
+
+def run_password_work(func, *args):
+    try:
+        return password_pool.run(func, *args)
+    except PasswordPoolFullError:
+        raise ServiceUnavailableError("Server is busy, try again later.")
+
 def hash_password(plaintext: str) -> str:
-    return bcrypt.hashpw(plaintext.encode(), bcrypt.gensalt()).decode()
+    return run_password_work(bcrypt.hashpw, plaintext.encode(), bcrypt.gensalt()).decode()
 
 def create_token():
     return ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for _ in range(36))
@@ -152,6 +273,27 @@ def success(message: str, data: Any = None):
     if data != None: d['data'] = data
     return jsonify(d)
 
+def stream_success(message: str, chunks: Iterable[list[dict[str, Any]]]):
+    """
+    Like `success`, but `data` is a list that is encoded and sent chunk by chunk
+    instead of being built in memory. Errors after the first chunk can't change
+    the status code anymore, the response is cut short instead.
+    """
+
+    def generate():
+        yield json.dumps({ "success": True, "message": str(message) })[:-1] + ', "data": ['
+
+        first = True
+        for chunk in chunks:
+            if not chunk: continue
+            encoded = ", ".join(json.dumps(item) for item in chunk)
+            yield encoded if first else ", " + encoded
+            first = False
+
+        yield "]}"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
 def handle_errors(func):
     def check_errors(*args, **kwargs):
         try:
@@ -166,19 +308,47 @@ def handle_errors(func):
             return error(err), 404
         except ConflictError as err:
             return error(err), 409
+        except TooManyRequestsError as err:
+            return error(err), 429, {"Retry-After": str(math.ceil(err.retry_after))}
         except InternalServerError as err:
             return error(err), 500
+        except ServiceUnavailableError as err:
+            return error(err), 503, {"Retry-After": "1"}
         except Exception as err:
             return error(err), 500
 
     check_errors.__name__ = func.__name__
     return check_errors
 
+def make_etag(kind: str, email: str, version: int) -> str:
+    # The email is part of it since the by_token URLs are shared by every user.
+    return f"{kind}{version}-{zlib.crc32(email.encode()):08x}"
+
+def etag_headers(etag: str) -> dict[str, str]:
+    return {
+        "ETag": f'"{etag}"',
+        "Cache-Control": "private, no-cache",
+        "Vary": "Authorization",
+    }
+
+def is_not_modified(etag: str) -> bool:
+    """
+    Whether the client's If-None-Match already has the current version.
+    """
+
+    return request.if_none_match.contains_weak(etag)
+
+def not_modified(etag: str):
+    return "", 304, etag_headers(etag)
+
 def protected(func):
     def check_token(*args, **kwargs):
         if 'Authorization' not in request.headers:
             return error("You are not signed in."), 401
-        if not database_helper.check_session(request.headers['Authorization']):
+
+        # Routes read the signed in user from `g.email` instead of querying the session again.
+        g.email = database_helper.try_get_email_from_session(request.headers['Authorization'])
+        if g.email == None:
             return error("You are not signed in."), 401
 
         return func(*args, **kwargs)
@@ -196,7 +366,7 @@ def check_password(email: str, password: str) -> bool:
     if password_hash == None:
         return False
 
-    if not bcrypt.checkpw(password.encode(), password_hash.encode()):
+    if not run_password_work(bcrypt.checkpw, password.encode(), password_hash.encode()):
         return False
     
     return True
\ No newline at end of file
@@ -0,0 +1,182 @@
+import bisect
+import functools
+import threading
+import time
+from typing import Callable
+
+# Seconds, roughly covers everything from a cached lookup to a bcrypt hash.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+Labels = tuple[tuple[str, str], ...]
+
+def format_labels(labels: Labels, extra: tuple[str, str] | None = None) -> str:
+    if extra != None:
+        labels = labels + (extra,)
+    if not labels:
+        return ""
+
+    def escape(value: str) -> str:
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for (key, value) in labels) + "}"
+
+def format_value(value: float) -> str:
+    if value == float("inf"): return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    name: str
+    help: str
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+
+        self._values: dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for (labels, value) in self._values.items():
+                lines.append(f"{self.name}{format_labels(labels)} {format_value(value)}")
+        return lines
+
+class Histogram:
+    name: str
+    help: str
+    buckets: tuple[float, ...]
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+
+        # Labels -> (per bucket counts, +Inf included, sum)
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def time(self, **labels: str):
+        """
+        Decorator observing how long each call takes.
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+            return timed
+        return decorator
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for (labels, (counts, total)) in self._values.items():
+                cumulative = 0
+                for (bound, count) in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(labels, ('le', format_value(bound)))} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(total[0])}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+class Gauge:
+    """
+    Read at scrape time from `callback`, which returns either a single value or
+    a list of (labels, value) pairs.
+    """
+
+    name: str
+    help: str
+    callback: Callable[[], float | list[tuple[dict[str, str], float]]]
+
+    def __init__(self, name: str, help: str, callback: Callable[[], float | list[tuple[dict[str, str], float]]]):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.callback()
+        except Exception as err:
+            print(err)
+            return lines
+
+        if not isinstance(values, list):
+            values = [({}, values)]
+        for (labels, value) in values:
+            lines.append(f"{self.name}{format_labels(tuple(sorted(labels.items())))} {format_value(value)}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def counter(name: str, help: str) -> Counter:
+    return registry.register(Counter(name, help))
+
+def histogram(name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, help, buckets))
+
+def gauge(name: str, help: str, callback) -> Gauge:
+    return registry.register(Gauge(name, help, callback))
+
+def stats_gauges(prefix: str, help: str, stats: Callable[[], dict[str, float]]):
+    """
+    Exposes every numeric entry of a `stats()` dict as `<prefix>_<key>`.
+    """
+
+    for key in stats().keys():
+        gauge(f"{prefix}_{key}", f"{help} ({key}).", lambda key=key: stats()[key])
+
+request_count = counter("twidder_http_requests_total", "HTTP requests by route and status.")
+request_latency = histogram("twidder_http_request_seconds", "HTTP request latency by route.")
+query_latency = histogram("twidder_db_query_seconds", "database_helper call latency by query.")
+cache_lookups = counter("twidder_cache_lookups_total", "Cache lookups by cache and outcome (hit, miss).")
+password_latency = histogram("twidder_password_seconds", "bcrypt hash/check duration.", (0.05, 0.1, 0.2, 0.3, 0.5, 1, 2, 5))
+geocode_latency = histogram("twidder_geocode_seconds", "Region lookup duration.")
+
+def timed_query(func):
+    """
+    Records the call count and latency of a database_helper function, only
+    for functions that always run SQL, cache hits aren't queries.
+    """
+
+    return query_latency.time(query=func.__name__)(func)
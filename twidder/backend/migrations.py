@@ -0,0 +1,158 @@
+import sqlite3
+
+# Each entry upgrades the schema by one version (tracked in PRAGMA user_version).
+# Never edit a migration that has shipped, append a new one instead, and keep
+# schema.sql in sync with the result. Statements may use the named parameters
+# bound by `migrate`.
+MIGRATIONS: list[list[str]] = [
+    # 1: Initial schema.
+    [
+        """
+        CREATE TABLE IF NOT EXISTS User (
+            Email TEXT NOT NULL PRIMARY KEY,
+            PasswordHash TEXT NOT NULL,
+            FirstName TEXT NOT NULL,
+            FamilyName TEXT NOT NULL,
+            Gender TEXT NOT NULL,
+            City TEXT NOT NULL,
+            Country TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS Session (
+            Token TEXT NOT NULL PRIMARY KEY,
+            Email TEXT NOT NULL,
+            FOREIGN KEY (Email) REFERENCES User (Email)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS Message (
+            Recipient TEXT NOT NULL,
+            Author TEXT NOT NULL,
+            Contents TEXT NOT NULL,
+            Region TEXT,
+            FOREIGN KEY (Recipient) REFERENCES User (Email) FOREIGN KEY (Author) REFERENCES User (Email)
+        )
+        """,
+    ],
+    # 2: Stable message ids and timestamps, indexed for wall pagination.
+    [
+        """
+        CREATE TABLE MessageNew (
+            Id INTEGER PRIMARY KEY AUTOINCREMENT,
+            Recipient TEXT NOT NULL,
+            Author TEXT NOT NULL,
+            Contents TEXT NOT NULL,
+            Region TEXT,
+            Created INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            FOREIGN KEY (Recipient) REFERENCES User (Email),
+            FOREIGN KEY (Author) REFERENCES User (Email)
+        )
+        """,
+        # Existing messages keep their rowid order, their real post time is unknown.
+        """
+        INSERT INTO MessageNew (Id, Recipient, Author, Contents, Region)
+        SELECT rowid, Recipient, Author, Contents, Region FROM Message ORDER BY rowid
+        """,
+        "DROP TABLE Message",
+        "ALTER TABLE MessageNew RENAME TO Message",
+        "CREATE INDEX Message_Recipient_Id ON Message (Recipient, Id)",
+    ],
+    # 3: Full-text search over message contents, kept in sync by triggers.
+    [
+        "CREATE VIRTUAL TABLE MessageSearch USING fts5(Contents, content='Message', content_rowid='Id')",
+        """
+        CREATE TRIGGER Message_Search_Insert AFTER INSERT ON Message BEGIN
+            INSERT INTO MessageSearch (rowid, Contents) VALUES (new.Id, new.Contents);
+        END
+        """,
+        """
+        CREATE TRIGGER Message_Search_Delete AFTER DELETE ON Message BEGIN
+            INSERT INTO MessageSearch (MessageSearch, rowid, Contents) VALUES ('delete', old.Id, old.Contents);
+        END
+        """,
+        # Only contents are indexed, region updates don't need to touch the index.
+        """
+        CREATE TRIGGER Message_Search_Update AFTER UPDATE OF Contents ON Message BEGIN
+            INSERT INTO MessageSearch (MessageSearch, rowid, Contents) VALUES ('delete', old.Id, old.Contents);
+            INSERT INTO MessageSearch (rowid, Contents) VALUES (new.Id, new.Contents);
+        END
+        """,
+        "INSERT INTO MessageSearch (MessageSearch) VALUES ('rebuild')",
+    ],
+    # 4: Session timestamps and expiry, indexed for the sweeper and per-user lookups.
+    [
+        """
+        CREATE TABLE SessionNew (
+            Token TEXT NOT NULL PRIMARY KEY,
+            Email TEXT NOT NULL,
+            Created INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            LastSeen INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            ExpiresAt INTEGER NOT NULL,
+            FOREIGN KEY (Email) REFERENCES User (Email)
+        )
+        """,
+        # Existing sessions get a fresh lifetime, the same as a new session.
+        """
+        INSERT INTO SessionNew (Token, Email, ExpiresAt)
+        SELECT Token, Email, CAST(strftime('%s', 'now') AS INTEGER) + :session_lifetime FROM Session
+        """,
+        "DROP TABLE Session",
+        "ALTER TABLE SessionNew RENAME TO Session",
+        "CREATE INDEX Session_Email ON Session (Email)",
+        "CREATE INDEX Session_ExpiresAt ON Session (ExpiresAt)",
+    ],
+    # 5: Per-user version counters for ETags, bumped by triggers on every change.
+    [
+        "ALTER TABLE User ADD COLUMN WallVersion INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE User ADD COLUMN ProfileVersion INTEGER NOT NULL DEFAULT 0",
+        """
+        CREATE TRIGGER Message_Wall_Insert AFTER INSERT ON Message BEGIN
+            UPDATE User SET WallVersion = WallVersion + 1 WHERE Email = new.Recipient;
+        END
+        """,
+        """
+        CREATE TRIGGER Message_Wall_Update AFTER UPDATE OF Contents, Region ON Message BEGIN
+            UPDATE User SET WallVersion = WallVersion + 1 WHERE Email = new.Recipient;
+        END
+        """,
+        """
+        CREATE TRIGGER Message_Wall_Delete AFTER DELETE ON Message BEGIN
+            UPDATE User SET WallVersion = WallVersion + 1 WHERE Email = old.Recipient;
+        END
+        """,
+        """
+        CREATE TRIGGER User_Profile_Update AFTER UPDATE OF FirstName, FamilyName, Gender, City, Country ON User BEGIN
+            UPDATE User SET ProfileVersion = ProfileVersion + 1 WHERE Email = new.Email;
+        END
+        """,
+    ],
+]
+
+def migrate(con: sqlite3.Connection, session_lifetime: int):
+    """
+    Brings the database up to the latest schema version, `session_lifetime`
+    is the configured SESSION_LIFETIME.
+
+    Runs inside a single immediate transaction, so concurrent workers starting up
+    at the same time wait for each other instead of migrating twice.
+    """
+
+    parameters = { "session_lifetime": session_lifetime }
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            (version,) = con.execute("PRAGMA user_version").fetchone()
+            for (i, migration) in enumerate(MIGRATIONS[version:], start=version + 1):
+                print(f"Migrating database to version {i}.")
+                for statement in migration:
+                    con.execute(statement, parameters)
+                con.execute(f"PRAGMA user_version = {i}")
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+    finally:
+        con.isolation_level = isolation_level
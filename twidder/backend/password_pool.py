@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from twidder.threads import start_lazily
+from .metrics import password_latency, stats_gauges
+
+PASSWORD_WORKERS = int(os.environ.get("TWIDDER_PASSWORD_WORKERS", os.cpu_count() or 1))
+PASSWORD_QUEUE_LIMIT = int(os.environ.get("TWIDDER_PASSWORD_QUEUE_LIMIT", 32))
+
+class PasswordPoolFullError(Exception):
+    pass
+
+class PasswordPool:
+    """
+    Runs bcrypt work on a small dedicated thread pool.
+
+    bcrypt releases the GIL while hashing, so a thread pool is enough to keep the
+    request threads (and cheap reads) responsive. At most `workers` hashes run at
+    once and at most `queue_limit` more may wait; anything beyond that is rejected
+    immediately instead of piling up on the request threads.
+    """
+
+    workers: int
+    queue_limit: int
+
+    completed: int = 0
+    rejected: int = 0
+    total_latency: float = 0
+    max_latency: float = 0
+    total_wait: float = 0
+
+    def __init__(self, workers: int, queue_limit: int):
+        self.workers = workers
+        self.queue_limit = queue_limit
+
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
+        self._pending = 0
+        self._running = 0
+
+    def _start(self):
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="password")
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            start_lazily(self, self._start)
+            return self._executor
+
+    def _timed(self, submitted_at: float, func: Callable, args: tuple) -> Any:
+        started_at = time.perf_counter()
+        with self._lock:
+            self._running += 1
+            self.total_wait += started_at - submitted_at
+
+        try:
+            return func(*args)
+        finally:
+            latency = time.perf_counter() - started_at
+            password_latency.observe(latency, operation=func.__name__)
+            with self._lock:
+                self._running -= 1
+                self.completed += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def run(self, func: Callable, *args) -> Any:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordPoolFullError("Too many password operations in progress.")
+
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self._get_executor().submit(self._timed, time.perf_counter(), func, args)
+            return future.result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "running": self._running,
+                "queue_depth": self._pending - self._running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_latency": self.total_latency / self.completed if self.completed else 0,
+                "max_latency": self.max_latency,
+                "avg_wait": self.total_wait / self.completed if self.completed else 0,
+            }
+
+password_pool = PasswordPool(PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT)
+stats_gauges("twidder_password_pool", "Password worker pool", password_pool.stats)
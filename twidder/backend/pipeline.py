@@ -0,0 +1,221 @@
+import atexit
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from . import database_helper
+from .geocode import resolve_region
+from .metrics import stats_gauges
+from twidder.threads import start_lazily, started_here
+from twidder.websocket.bus import Event, bus
+from twidder.websocket.lib import ServerAction
+
+BATCH_SIZE = int(os.environ.get("TWIDDER_REGION_BATCH_SIZE", 32))
+BATCH_WINDOW = float(os.environ.get("TWIDDER_REGION_BATCH_WINDOW", 0.05))
+MAX_ATTEMPTS = int(os.environ.get("TWIDDER_REGION_MAX_ATTEMPTS", 5))
+RETRY_BACKOFF = float(os.environ.get("TWIDDER_REGION_RETRY_BACKOFF", 1))
+SHUTDOWN_TIMEOUT = float(os.environ.get("TWIDDER_REGION_SHUTDOWN_TIMEOUT", 10))
+# Jobs queued or waiting for a retry beyond this are dropped, their messages keep no region.
+MAX_QUEUE = int(os.environ.get("TWIDDER_REGION_MAX_QUEUE", 10000))
+# Lookups of a batch that run at once, a slow resolver only holds up its own batch this way.
+CONCURRENCY = int(os.environ.get("TWIDDER_REGION_CONCURRENCY", 8))
+
+class RegionJob:
+    # (message id, recipient), a message posted to several walls is resolved once.
+    messages: list[tuple[int, str]]
+    lat: float
+    lon: float
+    attempts: int = 0
+
+    def __init__(self, messages: list[tuple[int, str]], lat: float, lon: float):
+        self.messages = messages
+        self.lat = lat
+        self.lon = lon
+
+class RegionEnricher:
+    """
+    Background worker that fills in the region of already stored messages.
+
+    Jobs are collected into batches of up to `batch_size` (waiting at most
+    `batch_window` seconds for more to arrive), resolved, and written back in a
+    single transaction. The jobs of a batch are resolved `concurrency` at a
+    time. Failed jobs are retried with exponential backoff up to
+    `max_attempts` times. `on_resolved` is called for every job that got a
+    region.
+
+    At most `max_queue` jobs wait, either queued or for their retry, more are
+    dropped so a slow resolver can't make the backlog grow without bound.
+    """
+
+    batch_size: int
+    batch_window: float
+    max_attempts: int
+    retry_backoff: float
+    max_queue: int
+    concurrency: int
+    on_resolved: Callable[[RegionJob, str], None]
+
+    resolved: int = 0
+    failed: int = 0
+    retried: int = 0
+    dropped: int = 0
+
+    def __init__(self, batch_size: int, batch_window: float, max_attempts: int, retry_backoff: float, max_queue: int, concurrency: int, on_resolved: Callable[[RegionJob, str], None]):
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_queue = max_queue
+        self.concurrency = concurrency
+        self.on_resolved = on_resolved
+
+        self._ready: deque[RegionJob] = deque()
+        # (not_before, seq, job), jobs waiting for their retry backoff.
+        self._delayed: list[tuple[float, int, RegionJob]] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        self._stopping = False
+
+    def submit(self, job: RegionJob):
+        with self._cond:
+            if self._stopping:
+                # The message is already stored, it just stays without a region.
+                print(f"Region enricher is shutting down, skipping messages {[id for (id, _) in job.messages]}")
+                self.failed += 1
+                return
+            if len(self._ready) + len(self._delayed) >= self.max_queue:
+                print(f"Region queue is full, skipping messages {[id for (id, _) in job.messages]}")
+                self.dropped += 1
+                return
+            start_lazily(self, self._start)
+
+            self._ready.append(job)
+            self._cond.notify()
+
+    def _start(self):
+        self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix="region-resolver")
+        self._thread = threading.Thread(target=self._run, name="region-enricher", daemon=True)
+        self._thread.start()
+
+    def _promote_delayed(self, now: float):
+        while self._delayed and (self._stopping or self._delayed[0][0] <= now):
+            _, _, job = heapq.heappop(self._delayed)
+            self._ready.append(job)
+
+    def _next_batch(self) -> list[RegionJob] | None:
+        with self._cond:
+            # Wait for the first job.
+            while True:
+                now = time.monotonic()
+                self._promote_delayed(now)
+                if self._ready: break
+                if self._stopping: return None
+
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
+
+            # Give concurrent posts a moment to join the batch.
+            deadline = time.monotonic() + self.batch_window
+            while len(self._ready) < self.batch_size and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                self._cond.wait(remaining)
+
+            batch = []
+            while self._ready and len(batch) < self.batch_size:
+                batch.append(self._ready.popleft())
+            return batch
+
+    def _retry(self, jobs: list[RegionJob], err: Exception):
+        with self._cond:
+            for job in jobs:
+                job.attempts += 1
+                if job.attempts >= self.max_attempts or self._stopping:
+                    print(f"Giving up on region for messages {[id for (id, _) in job.messages]}: {err}")
+                    self.failed += 1
+                    continue
+
+                self.retried += 1
+                not_before = time.monotonic() + self.retry_backoff * 2 ** (job.attempts - 1)
+                heapq.heappush(self._delayed, (not_before, next(self._seq), job))
+            self._cond.notify()
+
+    def _resolve(self, job: RegionJob) -> str | Exception | None:
+        try:
+            return resolve_region(job.lat, job.lon)
+        except Exception as err:
+            return err
+
+    def _process(self, batch: list[RegionJob]):
+        try:
+            results = list(self._executor.map(self._resolve, batch))
+        except RuntimeError:
+            # The interpreter is exiting and the lookup pool is gone, finish the batch here.
+            results = [self._resolve(job) for job in batch]
+
+        resolved = []
+        for (job, region) in zip(batch, results):
+            if isinstance(region, Exception):
+                self._retry([job], region)
+            elif region != None:
+                resolved.append((job, region))
+
+        if not resolved: return
+
+        try:
+            database_helper.set_message_regions([(region, id) for (job, region) in resolved for (id, _) in job.messages])
+        except Exception as err:
+            self._retry([job for (job, _) in resolved], err)
+            return
+
+        self.resolved += sum(len(job.messages) for (job, _) in resolved)
+        for (job, region) in resolved:
+            try:
+                self.on_resolved(job, region)
+            except Exception as err:
+                print(err)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None: return
+            self._process(batch)
+
+    def shutdown(self, timeout: float | None = None):
+        """
+        Stops accepting jobs and waits for the queued ones to be processed once,
+        retries are not attempted while draining.
+        """
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread if started_here(self) else None
+
+        if thread != None:
+            thread.join(timeout)
+
+    def stats(self) -> dict[str, int]:
+        with self._cond:
+            return {
+                "queued": len(self._ready),
+                "delayed": len(self._delayed),
+                "resolved": self.resolved,
+                "failed": self.failed,
+                "retried": self.retried,
+                "dropped": self.dropped,
+            }
+
+def notify_region_resolved(job: RegionJob, region: str):
+    bus.publish_many([Event(ServerAction.MESSAGE_UPDATED, recipient, { "id": id, "region": region }) for (id, recipient) in job.messages])
+
+region_enricher = RegionEnricher(BATCH_SIZE, BATCH_WINDOW, MAX_ATTEMPTS, RETRY_BACKOFF, MAX_QUEUE, CONCURRENCY, notify_region_resolved)
+atexit.register(region_enricher.shutdown, SHUTDOWN_TIMEOUT)
+stats_gauges("twidder_region_enricher", "Region enricher", region_enricher.stats)
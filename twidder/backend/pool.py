@@ -0,0 +1,149 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable
+
+from .migrations import migrate
+
+DATABASE_PATH = os.environ.get("TWIDDER_DATABASE", "database.db")
+POOL_SIZE = int(os.environ.get("TWIDDER_DB_POOL_SIZE", 16))
+POOL_TIMEOUT = float(os.environ.get("TWIDDER_DB_POOL_TIMEOUT", 10))
+# Sessions expire after this many seconds without being used. Defined here since migrations need it too.
+SESSION_LIFETIME = int(os.environ.get("TWIDDER_SESSION_LIFETIME", 30 * 24 * 60 * 60))
+
+# Applied to every connection when it is opened.
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+]
+
+# Number of compiled statements each connection keeps around for reuse.
+STATEMENT_CACHE_SIZE = 256
+
+class PoolTimeoutError(Exception):
+    pass
+
+class ConnectionPool:
+    """
+    Bounded pool of long-lived SQLite connections shared between request threads.
+
+    Connections are created lazily up to `size` and handed out LIFO, so a mostly
+    idle server keeps reusing the same warm connection (and its statement cache).
+    """
+
+    path: str
+    size: int
+    timeout: float
+    # Run once on the first connection opened by each process, e.g. to migrate the schema.
+    setup: Callable[[sqlite3.Connection], None] | None
+
+    def __init__(self, path: str, size: int, timeout: float, setup: Callable[[sqlite3.Connection], None] | None = None):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.setup = setup
+
+        self._setup_done = False
+        self._setup_lock = threading.Lock()
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._pid = os.getpid()
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(
+            self.path,
+            timeout=5,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        for pragma in PRAGMAS:
+            con.execute(pragma)
+
+        if self.setup != None and not self._setup_done:
+            with self._setup_lock:
+                if not self._setup_done:
+                    try:
+                        self.setup(con)
+                    except Exception:
+                        con.close()
+                        raise
+                    self._setup_done = True
+        return con
+
+    def _reset_after_fork(self):
+        # Connections must never be shared across processes (e.g. gunicorn --preload).
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._pid = os.getpid()
+        self._setup_done = False
+
+    def acquire(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset_after_fork()
+
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeoutError("Timed out waiting for a database connection.")
+
+    def release(self, con: sqlite3.Connection):
+        if con.in_transaction:
+            con.rollback()
+        self._idle.put(con)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a `with` block.
+
+        Behaves like `with sqlite3.connect(...) as con`, committing on success and
+        rolling back on error, but the connection is returned to the pool afterwards
+        instead of being closed.
+        """
+
+        con = self.acquire()
+        try:
+            with con:
+                yield con
+        finally:
+            self.release(con)
+
+    def close(self):
+        with self._lock:
+            while True:
+                try:
+                    con = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                con.close()
+                self._created -= 1
+
+pool = ConnectionPool(DATABASE_PATH, POOL_SIZE, POOL_TIMEOUT, partial(migrate, session_lifetime=SESSION_LIFETIME))
@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+from typing import Callable, Hashable
+
+from flask import g, request
+
+from .lib import TooManyRequestsError
+from .metrics import counter, gauge
+
+# Set to 0 to turn every limit off, e.g. for load tests.
+RATE_LIMIT = os.environ.get("TWIDDER_RATE_LIMIT", "1") == "1"
+# Reverse proxies in front of gunicorn, the client address is this many entries from the end of X-Forwarded-For.
+# gunicorn only listens on localhost, so there is one by default. Set to 0 when clients connect directly,
+# otherwise they could pick their own address.
+RATE_LIMIT_PROXIES = int(os.environ.get("TWIDDER_RATE_LIMIT_PROXIES", 1))
+# Most buckets a limiter keeps, the least recently used are forgotten beyond that.
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("TWIDDER_RATE_LIMIT_MAX_KEYS", 100000))
+
+rate_limited_count = counter("twidder_rate_limited_total", "Requests refused by a rate limit, by limit.")
+
+def parse_limit(name: str, default: str) -> tuple[int, float]:
+    """
+    Reads TWIDDER_RATE_LIMIT_<name>, formatted "<requests>/<seconds>".
+    """
+
+    (requests, seconds) = os.environ.get(f"TWIDDER_RATE_LIMIT_{name.upper()}", default).split("/")
+    return (int(requests), float(seconds))
+
+class RateLimiter:
+    """
+    Token buckets by key, each holding up to `burst` tokens and refilling
+    `burst` tokens every `period` seconds.
+
+    A bucket left alone for `period` seconds is full again, which is the same
+    as not having one, so buckets are only kept while they are refilling. The
+    dict is ordered by last use, expired buckets are dropped from its front on
+    every call.
+
+    Buckets are per worker process.
+    """
+
+    name: str
+    burst: int
+    period: float
+    max_keys: int
+
+    def __init__(self, name: str, burst: int, period: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.name = name
+        self.burst = burst
+        self.period = period
+        self.max_keys = max_keys
+        self.rate = burst / period
+
+        # Key -> (tokens, time.monotonic() of the last update)
+        self._buckets: dict[Hashable, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, name: str, default: str) -> "RateLimiter":
+        return cls(name, *parse_limit(name, default))
+
+    def acquire(self, key: Hashable, cost: float = 1) -> float:
+        """
+        Takes `cost` tokens from `key`'s bucket. Returns 0 if there were enough,
+        otherwise how many seconds until there are, nothing is taken then.
+        """
+
+        if not RATE_LIMIT: return 0
+
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0
+            else:
+                wait = (cost - tokens) / self.rate
+            # Reinserted so the dict stays ordered by last use.
+            self._buckets[key] = (tokens, now)
+
+            while self._buckets:
+                oldest = next(iter(self._buckets))
+                if now - self._buckets[oldest][1] < self.period and len(self._buckets) <= self.max_keys: break
+                del self._buckets[oldest]
+
+        if wait > 0:
+            rate_limited_count.inc(limit=self.name)
+        return wait
+
+    def keys(self) -> int:
+        with self._lock:
+            return len(self._buckets)
+
+def forwarded_ip(route: list[str], remote_addr: str) -> str:
+    """
+    The client address given X-Forwarded-For's entries (`route`) and the
+    address of whoever connected.
+    """
+
+    if RATE_LIMIT_PROXIES > 0 and route:
+        return route[max(0, len(route) - RATE_LIMIT_PROXIES)]
+    return remote_addr
+
+def client_ip() -> str:
+    return forwarded_ip(request.access_route, request.remote_addr)
+
+def signed_in_email() -> str | None:
+    # Set by `protected`.
+    return g.get('email')
+
+def sign_in_email() -> str | None:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('username'), str): return None
+    return data['username'].lower()
+
+def rate_limited(limiter: RateLimiter, key: Callable[[], Hashable | None]):
+    """
+    Refuses requests with 429 once `key()`'s bucket is empty, requests without
+    a key aren't limited. Goes below `handle_errors`, and below `protected` when
+    keyed by the signed in user.
+    """
+
+    def decorator(func):
+        def check_rate(*args, **kwargs):
+            k = key()
+            if k != None:
+                wait = limiter.acquire(k)
+                if wait > 0:
+                    raise TooManyRequestsError("Too many requests, try again later.", wait)
+            return func(*args, **kwargs)
+
+        check_rate.__name__ = func.__name__
+        return check_rate
+    return decorator
+
+# bcrypt makes signing in, up and changing passwords expensive.
+sign_in_ip_limiter = RateLimiter.from_env("sign_in_ip", "20/60")
+sign_in_email_limiter = RateLimiter.from_env("sign_in_email", "5/60")
+sign_up_limiter = RateLimiter.from_env("sign_up", "5/60")
+change_password_limiter = RateLimiter.from_env("change_password", "5/60")
+post_limiter = RateLimiter.from_env("post", "20/10")
+broadcast_limiter = RateLimiter.from_env("broadcast", "5/60")
+search_limiter = RateLimiter.from_env("search", "30/10")
+presence_limiter = RateLimiter.from_env("presence", "30/10")
+# Every websocket request, by user once logged in.
+socket_limiter = RateLimiter.from_env("socket", "30/10")
+
+limiters = [sign_in_ip_limiter, sign_in_email_limiter, sign_up_limiter, change_password_limiter, post_limiter, broadcast_limiter, search_limiter, presence_limiter, socket_limiter]
+gauge("twidder_rate_limit_keys", "Token buckets currently refilling, over every limit.", lambda: sum(limiter.keys() for limiter in limiters))
@@ -1,20 +1,85 @@
-import json
-from flask import request
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+import time
+from flask import Response, g, request
 from twidder import app
 import bcrypt
 from . import database_helper
-from .lib import BadRequestError, ChangePasswordData, ConflictError, ForbiddenError, NotFoundError, PostMessageData, SignInData, SignUpData, UnauthorizedError, check_password, create_token, handle_errors, hash_password, protected, success
+from . import metrics
+from .pipeline import RegionJob, region_enricher
+from .ratelimit import broadcast_limiter, change_password_limiter, client_ip, post_limiter, presence_limiter, rate_limited, search_limiter, sign_in_email, sign_in_email_limiter, sign_in_ip_limiter, sign_up_limiter, signed_in_email
+from .sweeper import session_sweeper
+from .lib import BadRequestError, ChangePasswordData, ConflictError, ForbiddenError, NotFoundError, PaginationData, PostMessageData, PostMessagesData, PresenceData, SearchData, SignInData, SignUpData, UnauthorizedError, check_password, create_token, etag_headers, handle_errors, hash_password, is_not_modified, make_etag, not_modified, protected, stream_success, success, validate_email
+from twidder.websocket.bus import SESSION_REVOKED, USER_CHANGED, Event, bus
 from twidder.websocket.lib import ServerAction
-from twidder.websocket.server_socket import activeConnections
-import requests
+from twidder.websocket.presence import presence
+
+# Profile requests sent with an "X-Profile: 1" header.
+PROFILER = os.environ.get("TWIDDER_PROFILER", "0") == "1"
+# Fraction of all requests to profile regardless of the header.
+PROFILE_SAMPLE_RATE = float(os.environ.get("TWIDDER_PROFILE_SAMPLE_RATE", 0))
+# cProfile is process wide, only one request can be profiled at a time.
+profiler_lock = threading.Lock()
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+
+    if (PROFILER and request.headers.get('X-Profile') == '1') \
+        or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+        # Skipped while another request is being profiled.
+        if profiler_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+@app.before_request
+def start_session_sweeper():
+    # Idempotent, runs one sweeper per worker process.
+    session_sweeper.start()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.endpoint or "unknown"
+    metrics.request_count.inc(route=route, status=str(response.status_code))
+    metrics.request_latency.observe(time.perf_counter() - g.request_start, route=route)
+    return response
+
+@app.teardown_request
+def stop_profiler(err):
+    # Runs even when the request failed before after_request.
+    profiler = g.pop('profiler', None)
+    if profiler == None: return
+
+    try:
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(25)
+        print(f"Profile for {request.method} {request.path}:\n{out.getvalue()}")
+    finally:
+        profiler_lock.release()
+
+@app.route("/metrics", methods = ['GET'])
+def get_metrics():
+    """
+    Prometheus text exposition of the server's metrics.
+    """
+
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
 
 @app.route("/sign_in", methods = ['POST'])
 @handle_errors
+@rate_limited(sign_in_ip_limiter, client_ip)
+@rate_limited(sign_in_email_limiter, sign_in_email)
 def sign_in():
     """
     HTTP Error Codes:
     500 Bad Request - Missing or invalid data. (Should be validated by client.)
     401 Unauthorized - Invalid credentials.
+    429 Too Many Requests - Too many attempts from this address or for this email.
     """
 
     data = SignInData(request.json)
@@ -29,11 +94,13 @@ def sign_in():
 
 @app.route("/sign_up", methods = ['POST'])
 @handle_errors
+@rate_limited(sign_up_limiter, client_ip)
 def sign_up():
     """
     HTTP Error Codes:
     500 Bad Request - Missing or invalid data. (Should be validated by client.)
     409 Conflict - User already exists.
+    429 Too Many Requests - Too many sign ups from this address.
     """
 
     data = SignUpData(request.json)
@@ -42,6 +109,8 @@ def sign_up():
         raise ConflictError("User already exists.")
 
     database_helper.insert_user(data)
+    # Other workers may have cached the email as unknown.
+    bus.publish(Event(USER_CHANGED, data.email, data.email))
 
     return success("Successfully created a new user."), 201
 
@@ -51,13 +120,12 @@ def sign_up():
 def get_user_data_by_token():
     """
     HTTP Error Codes:
+    304 Not Modified - If-None-Match has the current ETag.
     401 Unauthorized - Not logged in or invalid token.
     """
 
-    email = database_helper.get_email_from_session(request.headers['Authorization'])
-    user = database_helper.get_user_by_email(email)
-
-    return success("User data retrieved.", user.as_dict()), 200
+    email = g.email
+    return get_user_data(email)
 
 @app.route("/get_user_data_by_email/<email>", methods = ['GET'])
 @protected
@@ -65,96 +133,225 @@ def get_user_data_by_token():
 def get_user_data_by_email(email):
     """
     HTTP Error Codes:
+    304 Not Modified - If-None-Match has the current ETag.
     401 Unauthorized - Not logged in or invalid token.
     404 Not Found - No user with the email found.
     """
 
+    return get_user_data(email)
+
+def get_user_data(email: str):
+    # Served from the user cache, a matching If-None-Match skips building the response.
     user = database_helper.get_user_by_email(email)
+    etag = make_etag("p", email, user.profile_version)
+    if is_not_modified(etag):
+        return not_modified(etag)
 
-    return success("User data retrieved.", user.as_dict()), 200
+    return success("User data retrieved.", user.as_dict()), 200, etag_headers(etag)
 
 @app.route("/change_password", methods = ['PUT'])
 @protected
 @handle_errors
+@rate_limited(change_password_limiter, signed_in_email)
 def change_password():
     """
     HTTP Error Codes:
     500 Bad Request - Missing or invalid data. (Should be validated by client.)
     401 Unauthorized - Not logged in or invalid token.
     403 Forbidden - Invalid credentials.
+    429 Too Many Requests - Too many attempts.
     """
 
     data = ChangePasswordData(request.json)
-    email = database_helper.get_email_from_session(request.headers['Authorization'])
+    email = g.email
 
     if not check_password(email, data.old_password):
         raise ForbiddenError("Wrong password.")
     database_helper.change_password(email, hash_password(data.new_password))
+    bus.publish(Event(USER_CHANGED, email, email))
 
     return success("Password changed."), 200
 
 @app.route("/post_message", methods = ['POST'])
 @protected
 @handle_errors
+@rate_limited(post_limiter, signed_in_email)
 def post_message():
     """
     HTTP Error Codes:
     500 Bad Request - Missing or invalid data. (Should be validated by client.)
     401 Unauthorized - Not logged in or invalid token.
     404 Not Found -  Recipient was not found.
+    429 Too Many Requests - Posting too fast.
     """
 
     data = PostMessageData(request.json)
-    email = database_helper.get_email_from_session(request.headers['Authorization'])
+    email = g.email
 
     if not database_helper.check_user_exists(data.recipient):
         raise NotFoundError("No such recipient.")
 
-    recipientClient = activeConnections.get(data.recipient)
-    if (recipientClient != None):
-        recipientClient.send(ServerAction.NEW_MESSAGE)
-
-    resp = requests.get(f"https://geocode.xyz/{data.lat},{data.lon}?json=1")
-    resp = json.loads(resp.text)
+    # Store the message right away, the region is filled in by the background enricher.
+    message = database_helper.post_message(email, data.message, data.recipient, None)
 
-    region = None
-    if float(resp['standard']['confidence']) > 0.5:
-        region = resp['standard']['region']
+    # The recipient's client adds it to the wall as is, no refetch needed.
+    bus.publish(Event(ServerAction.NEW_MESSAGE, data.recipient, message.as_dict()))
 
-    database_helper.post_message(email, data.message, data.recipient, region)
+    if data.lat != None and data.lon != None:
+        region_enricher.submit(RegionJob([(message.id, data.recipient)], data.lat, data.lon))
 
     return success("Message posted."), 201
 
+@app.route("/post_messages", methods = ['POST'])
+@protected
+@handle_errors
+@rate_limited(broadcast_limiter, signed_in_email)
+def post_messages():
+    """
+    Posts the same message to several walls, `emails` is a list of recipients.
+    `data` has an entry per recipient telling whether it was posted there.
+
+    HTTP Error Codes:
+    400 Bad Request - Missing or invalid data.
+    401 Unauthorized - Not logged in or invalid token.
+    404 Not Found - None of the recipients were found.
+    429 Too Many Requests - Posting too fast.
+    """
+
+    data = PostMessagesData(request.json)
+    email = g.email
+
+    errors: dict[str, str] = {}
+    for recipient in data.recipients:
+        try:
+            validate_email(recipient)
+        except BadRequestError as err:
+            errors[recipient] = str(err)
+
+    existing = database_helper.get_existing_users([recipient for recipient in data.recipients if recipient not in errors])
+    recipients = [recipient for recipient in data.recipients if recipient in existing]
+    for recipient in data.recipients:
+        if recipient not in errors and recipient not in existing:
+            errors[recipient] = "No such recipient."
+
+    if not recipients:
+        raise NotFoundError("None of the recipients were found.")
+
+    messages = database_helper.post_messages(email, data.message, recipients, None)
+    bus.publish_many([Event(ServerAction.NEW_MESSAGE, recipient, message.as_dict()) for (recipient, message) in zip(recipients, messages)])
+
+    if data.lat != None and data.lon != None:
+        region_enricher.submit(RegionJob([(message.id, recipient) for (recipient, message) in zip(recipients, messages)], data.lat, data.lon))
+
+    ids = { recipient: message.id for (recipient, message) in zip(recipients, messages) }
+    results = []
+    for recipient in data.recipients:
+        if recipient in ids:
+            results.append({ "email": recipient, "success": True, "id": ids[recipient] })
+        else:
+            results.append({ "email": recipient, "success": False, "message": errors[recipient] })
+
+    return success(f"Message posted to {len(recipients)} of {len(data.recipients)} walls.", results), 201
+
 @app.route("/get_user_messages_by_token", methods = ['GET'])
 @protected
 @handle_errors
 def get_user_messages_by_token():
     """
+    Query parameters:
+    before - Only return messages older than this message id.
+    since - Only return messages newer than this message id, oldest first.
+    limit - Maximum number of messages to return, newest first.
+    stream - Set to 1 to stream the response, limit is then optional.
+
     HTTP Error Codes:
+    304 Not Modified - If-None-Match has the current ETag.
+    400 Bad Request - Invalid before, since or limit.
     401 Unauthorized - Not logged in or invalid token.
     """
 
-    email = database_helper.get_email_from_session(request.headers['Authorization'])
-    messages = database_helper.get_user_messages(email)
-
-    return success("User messages retrieved.", [message.as_dict() for message in messages]), 200
+    email = g.email
+    return get_user_messages(email)
 
 @app.route("/get_user_messages_by_email/<email>", methods = ['GET'])
 @protected
 @handle_errors
 def get_user_messages_by_email(email):
     """
+    Query parameters:
+    before - Only return messages older than this message id.
+    since - Only return messages newer than this message id, oldest first.
+    limit - Maximum number of messages to return, newest first.
+    stream - Set to 1 to stream the response, limit is then optional.
+
     HTTP Error Codes:
+    304 Not Modified - If-None-Match has the current ETag.
+    400 Bad Request - Invalid before, since or limit.
     401 Unauthorized - Not logged in or invalid token.
     404 Not Found - No user with the email found.
     """
 
-    if not database_helper.check_user_exists(email):
+    return get_user_messages(email)
+
+def get_user_messages(email: str):
+    page = PaginationData(request.args)
+
+    # The URL holds the page, so the wall version alone identifies the response. Read
+    # before the rows, so a concurrent post can only make the ETag older than the body.
+    version = database_helper.get_wall_version(email)
+    if version == None:
         raise BadRequestError("No such user.")
+    etag = make_etag("w", email, version)
+    if is_not_modified(etag):
+        return not_modified(etag)
+
+    if page.stream:
+        return stream_success("User messages retrieved.", database_helper.iter_user_messages(email, page.before, page.limit, page.since)), 200, etag_headers(etag)
+
+    messages = database_helper.get_user_messages(email, page.before, page.limit, page.since)
+
+    return success("User messages retrieved.", [message.as_dict() for message in messages]), 200, etag_headers(etag)
+
+@app.route("/search_messages", methods = ['GET'])
+@protected
+@handle_errors
+@rate_limited(search_limiter, signed_in_email)
+def search_messages():
+    """
+    Query parameters:
+    q - Words that must all appear in the message, end a word with * to match it as a prefix.
+    author, recipient, region - Optional exact filters.
+    limit, offset - Paging through the results, best matches first. offset is at most 1000.
+
+    HTTP Error Codes:
+    400 Bad Request - Missing query or invalid limit or offset.
+    401 Unauthorized - Not logged in or invalid token.
+    429 Too Many Requests - Searching too fast.
+    """
 
-    messages = database_helper.get_user_messages(email)
+    data = SearchData(request.args)
+    messages = database_helper.search_messages(data.query, data.author, data.recipient, data.region, data.limit, data.offset)
 
-    return success("User messages retrieved.", [message.as_dict() for message in messages]), 200
+    return success("Messages found.", messages), 200
+
+@app.route("/presence", methods = ['POST'])
+@protected
+@handle_errors
+@rate_limited(presence_limiter, signed_in_email)
+def get_presence():
+    """
+    Online status of every email in `emails`, as
+    { email: { "online": bool, "lastSeen": unix time or null } }.
+    Unknown emails are reported offline and never seen.
+
+    HTTP Error Codes:
+    400 Bad Request - Missing or too many emails.
+    401 Unauthorized - Not logged in or invalid token.
+    429 Too Many Requests - Asking too often.
+    """
+
+    data = PresenceData(request.json)
+    return success("Presence retrieved.", presence.lookup(data.emails)), 200
 
 @app.route("/sign_out", methods = ['DELETE'])
 @protected
@@ -166,4 +363,17 @@ def sign_out():
     """
 
     database_helper.delete_session(request.headers['Authorization'])
-    return success("Successfully signed out."), 200
\ No newline at end of file
+    bus.publish(Event(SESSION_REVOKED, g.email, database_helper.normalize_token(request.headers['Authorization'])))
+    return success("Successfully signed out."), 200
+
+def on_session_revoked(event: Event):
+    if event.action == SESSION_REVOKED:
+        database_helper.session_cache.invalidate(event.data)
+
+bus.subscribe(on_session_revoked)
+
+def on_user_changed(event: Event):
+    if event.action == USER_CHANGED:
+        database_helper.user_cache.invalidate(event.data)
+
+bus.subscribe(on_user_changed)
@@ -6,11 +6,13 @@ CREATE TABLE
         FamilyName TEXT NOT NULL,
         Gender TEXT NOT NULL,
         City TEXT NOT NULL,
-        Country TEXT NOT NULL
+        Country TEXT NOT NULL,
+        WallVersion INTEGER NOT NULL DEFAULT 0,
+        ProfileVersion INTEGER NOT NULL DEFAULT 0
     );
 
 INSERT INTO
-    User
+    User (Email, PasswordHash, FirstName, FamilyName, Gender, City, Country)
 VALUES
     (
         "a@a.ca",
@@ -23,7 +25,7 @@ VALUES
     );
 
 INSERT INTO
-    User
+    User (Email, PasswordHash, FirstName, FamilyName, Gender, City, Country)
 VALUES
     (
         "a@a.cb",
@@ -39,19 +41,65 @@ CREATE TABLE
     Session (
         Token TEXT NOT NULL PRIMARY KEY,
         Email TEXT NOT NULL,
+        Created INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        LastSeen INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        ExpiresAt INTEGER NOT NULL,
         FOREIGN KEY (Email) REFERENCES User (Email)
     );
 
+CREATE INDEX Session_Email ON Session (Email);
+
+CREATE INDEX Session_ExpiresAt ON Session (ExpiresAt);
+
 CREATE TABLE
     Message (
+        Id INTEGER PRIMARY KEY AUTOINCREMENT,
         Recipient TEXT NOT NULL,
         Author TEXT NOT NULL,
         Contents TEXT NOT NULL,
         Region TEXT,
-        FOREIGN KEY (Recipient) REFERENCES User (Email) FOREIGN KEY (Author) REFERENCES User (Email)
+        Created INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        FOREIGN KEY (Recipient) REFERENCES User (Email),
+        FOREIGN KEY (Author) REFERENCES User (Email)
     );
 
+CREATE INDEX Message_Recipient_Id ON Message (Recipient, Id);
+
+CREATE VIRTUAL TABLE MessageSearch USING fts5 (Contents, content = 'Message', content_rowid = 'Id');
+
+CREATE TRIGGER Message_Search_Insert AFTER INSERT ON Message BEGIN
+    INSERT INTO MessageSearch (rowid, Contents) VALUES (new.Id, new.Contents);
+END;
+
+CREATE TRIGGER Message_Search_Delete AFTER DELETE ON Message BEGIN
+    INSERT INTO MessageSearch (MessageSearch, rowid, Contents) VALUES ('delete', old.Id, old.Contents);
+END;
+
+CREATE TRIGGER Message_Search_Update AFTER UPDATE OF Contents ON Message BEGIN
+    INSERT INTO MessageSearch (MessageSearch, rowid, Contents) VALUES ('delete', old.Id, old.Contents);
+    INSERT INTO MessageSearch (rowid, Contents) VALUES (new.Id, new.Contents);
+END;
+
+CREATE TRIGGER Message_Wall_Insert AFTER INSERT ON Message BEGIN
+    UPDATE User SET WallVersion = WallVersion + 1 WHERE Email = new.Recipient;
+END;
+
+CREATE TRIGGER Message_Wall_Update AFTER UPDATE OF Contents, Region ON Message BEGIN
+    UPDATE User SET WallVersion = WallVersion + 1 WHERE Email = new.Recipient;
+END;
+
+CREATE TRIGGER Message_Wall_Delete AFTER DELETE ON Message BEGIN
+    UPDATE User SET WallVersion = WallVersion + 1 WHERE Email = old.Recipient;
+END;
+
+CREATE TRIGGER User_Profile_Update AFTER UPDATE OF FirstName, FamilyName, Gender, City, Country ON User BEGIN
+    UPDATE User SET ProfileVersion = ProfileVersion + 1 WHERE Email = new.Email;
+END;
+
 INSERT INTO
-    Message
+    Message (Recipient, Author, Contents, Region)
 VALUES
-    ("a@a.ca", "a@a.ca", "Hello :3", NULL);
\ No newline at end of file
+    ("a@a.ca", "a@a.ca", "Hello :3", NULL);
+
+-- Matches the last entry in migrations.py.
+PRAGMA user_version = 5;
\ No newline at end of file
@@ -0,0 +1,76 @@
+import os
+import threading
+import time
+
+from . import database_helper
+from .metrics import stats_gauges
+from twidder.threads import start_lazily
+
+SWEEP_INTERVAL = float(os.environ.get("TWIDDER_SESSION_SWEEP_INTERVAL", 300))
+SWEEP_CHUNK_SIZE = int(os.environ.get("TWIDDER_SESSION_SWEEP_CHUNK_SIZE", 500))
+# Pause between chunks so other writers get the lock in between.
+SWEEP_CHUNK_PAUSE = float(os.environ.get("TWIDDER_SESSION_SWEEP_CHUNK_PAUSE", 0.05))
+
+class SessionSweeper:
+    """
+    Periodically deletes expired sessions, `chunk_size` rows per transaction so
+    the write lock is only ever held briefly.
+    """
+
+    interval: float
+    chunk_size: int
+    chunk_pause: float
+
+    runs: int = 0
+    swept: int = 0
+
+    def __init__(self, interval: float, chunk_size: int, chunk_pause: float):
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.chunk_pause = chunk_pause
+
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Idempotent, starts the sweeper thread in the current process.
+        """
+
+        with self._lock:
+            start_lazily(self, self._start)
+
+    def _start(self):
+        threading.Thread(target=self._run, name="session-sweeper", daemon=True).start()
+
+    def sweep(self) -> int:
+        total = 0
+        while True:
+            deleted = database_helper.delete_expired_sessions(self.chunk_size)
+            total += deleted
+            if deleted < self.chunk_size: break
+            time.sleep(self.chunk_pause)
+
+        with self._lock:
+            self.runs += 1
+            self.swept += total
+        return total
+
+    def _run(self):
+        while True:
+            try:
+                deleted = self.sweep()
+                if deleted > 0:
+                    print(f"Deleted {deleted} expired sessions.")
+            except Exception as err:
+                print(err)
+            time.sleep(self.interval)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "swept": self.swept,
+            }
+
+session_sweeper = SessionSweeper(SWEEP_INTERVAL, SWEEP_CHUNK_SIZE, SWEEP_CHUNK_PAUSE)
+stats_gauges("twidder_session_sweeper", "Expired session sweeper", session_sweeper.stats)
@@ -0,0 +1,197 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from twidder.threads import start_lazily, started_here
+from .metrics import stats_gauges
+from .pool import ConnectionPool, pool
+
+WRITER_BATCH_SIZE = int(os.environ.get("TWIDDER_WRITER_BATCH_SIZE", 128))
+# How long the writer waits for more writes to join a batch that isn't full yet.
+WRITER_BATCH_WINDOW = float(os.environ.get("TWIDDER_WRITER_BATCH_WINDOW", 0.001))
+# How long a caller waits for its write to be committed.
+WRITER_TIMEOUT = float(os.environ.get("TWIDDER_WRITER_TIMEOUT", 10))
+WRITER_SHUTDOWN_TIMEOUT = float(os.environ.get("TWIDDER_WRITER_SHUTDOWN_TIMEOUT", 10))
+
+class WriterShutdownError(Exception):
+    pass
+
+class GroupCommitWriter:
+    """
+    Single writer thread committing concurrent writes together.
+
+    Writes are functions taking a connection. They are queued and run in batches
+    of up to `batch_size`, each batch in one transaction and each write in its
+    own savepoint, so a failing write doesn't take the rest of its batch with it.
+    A write's future resolves once its batch is committed.
+
+    While a batch commits the next one fills up, so under load batches grow on
+    their own, `batch_window` only helps when writes trickle in.
+    """
+
+    pool: ConnectionPool
+    batch_size: int
+    batch_window: float
+    timeout: float
+
+    batches: int = 0
+    writes: int = 0
+    failed: int = 0
+    max_batch: int = 0
+
+    def __init__(self, pool: ConnectionPool, batch_size: int, batch_window: float, timeout: float):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.timeout = timeout
+
+        self._queue: deque[tuple[Callable[[sqlite3.Connection], Any], Future]] = deque()
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._stopping = False
+
+    def submit(self, write: Callable[[sqlite3.Connection], Any]) -> Future:
+        future = Future()
+        with self._cond:
+            if self._stopping:
+                raise WriterShutdownError("Database writer is shutting down.")
+
+            start_lazily(self, self._start)
+
+            self._queue.append((write, future))
+            self._cond.notify()
+        return future
+
+    def _start(self):
+        # Writes queued before a fork are the parent's to commit.
+        self._queue.clear()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def run(self, write: Callable[[sqlite3.Connection], Any]) -> Any:
+        """
+        Submits `write` and waits until it is committed, returns its result.
+
+        Raises TimeoutError only if `write` is still queued after `timeout`, it
+        is cancelled then and never runs. Once its batch has started the outcome
+        is waited for, a caller must not report a failure for a write that may
+        still commit.
+        """
+
+        future = self.submit(write)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            if future.cancel(): raise
+            return future.result()
+
+    def _next_batch(self) -> list[tuple[Callable[[sqlite3.Connection], Any], Future]] | None:
+        with self._cond:
+            while not self._queue:
+                if self._stopping: return None
+                self._cond.wait()
+
+            deadline = time.monotonic() + self.batch_window
+            while len(self._queue) < self.batch_size and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                self._cond.wait(remaining)
+
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+            return batch
+
+    def _commit(self, batch: list[tuple[Callable[[sqlite3.Connection], Any], Future]]):
+        results: list[tuple[Future, Any, BaseException | None]] = []
+        con = None
+        try:
+            # Inside the try, a pool timeout must fail the batch instead of leaving its callers waiting.
+            con = self.pool.acquire()
+            isolation_level = con.isolation_level
+            con.isolation_level = None
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                for (write, future) in batch:
+                    # Cancelled by a caller that gave up waiting, it was told the write failed.
+                    if not future.set_running_or_notify_cancel(): continue
+
+                    con.execute("SAVEPOINT write")
+                    try:
+                        result = write(con)
+                    except Exception as err:
+                        con.execute("ROLLBACK TO write")
+                        results.append((future, None, err))
+                    else:
+                        results.append((future, result, None))
+                    con.execute("RELEASE write")
+                con.execute("COMMIT")
+            except BaseException:
+                if con.in_transaction:
+                    con.execute("ROLLBACK")
+                raise
+        except Exception as err:
+            # Nothing was committed, fail the whole batch.
+            for (write, future) in batch:
+                if not future.done():
+                    future.set_exception(err)
+            with self._cond:
+                self.failed += len(batch)
+            return
+        finally:
+            if con != None:
+                con.isolation_level = isolation_level
+                self.pool.release(con)
+
+        with self._cond:
+            self.batches += 1
+            self.writes += len(results)
+            self.max_batch = max(self.max_batch, len(batch))
+
+        for (future, result, err) in results:
+            if err != None:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None: return
+            try:
+                self._commit(batch)
+            except Exception as err:
+                print(err)
+
+    def shutdown(self, timeout: float | None = None):
+        """
+        Stops accepting writes and waits for the queued ones to be committed.
+        """
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread if started_here(self) else None
+
+        if thread != None:
+            thread.join(timeout)
+
+    def stats(self) -> dict[str, float]:
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "batches": self.batches,
+                "writes": self.writes,
+                "failed": self.failed,
+                "avg_batch": self.writes / self.batches if self.batches else 0,
+                "max_batch": self.max_batch,
+            }
+
+writer = GroupCommitWriter(pool, WRITER_BATCH_SIZE, WRITER_BATCH_WINDOW, WRITER_TIMEOUT)
+atexit.register(writer.shutdown, WRITER_SHUTDOWN_TIMEOUT)
+stats_gauges("twidder_writer", "Group commit writer", writer.stats)
@@ -16,11 +16,15 @@ const views = {
   },
 };
 
+/** @type {keyof views | undefined} */
+let _currentView = undefined;
+
 /**
  * @param {keyof views} name
  */
 const setView = (name) => {
   console.log(`Set view to ${name}`);
+  _currentView = name;
   const view = views[name];
   getRootElement().innerHTML = view.getView();
   view.onLoad();
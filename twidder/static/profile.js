@@ -120,20 +120,104 @@ const escapeHtml = (unsafe) => {
     .replaceAll("'", "&#039;");
 };
 
-const refreshMessageWall = async () => {
-  const messages = await server.getUserMessagesByEmail(getTargetUserEmail());
+const MESSAGE_PAGE_SIZE = 20;
+
+/** Id of the oldest message shown, used as the cursor for the next page.
+ * @type {number | undefined}
+ */
+let _oldestMessageId = undefined;
 
-  const messagesHtml = messages
-    .map(
-      (message) => `<li>
+/** Id of the newest message shown, used as the cursor for catching up.
+ * @type {number | undefined}
+ */
+let _newestMessageId = undefined;
+
+/** @param {string | null} region */
+const regionHtml = (region) =>
+  region ? `<br /><i>from ${escapeHtml(region)}</i>` : "";
+
+/** @param {WallMessage} message */
+const messageHtml = (message) => `<li data-message-id="${message.id}">
         ${escapeHtml(message.author)} says <em>${escapeHtml(
-        message.contents
-      )}</em>! ${message.region ? `<br /><i>from ${message.region}</i>` : ""}
-    </li>`
-    )
-    .join("<hr />");
+  message.contents
+)}</em>! <span class="message-region">${regionHtml(message.region)}</span>
+    </li>`;
+
+/** @param {WallMessage[]} messages */
+const updateWallCursor = (messages) => {
+  if (messages.length > 0) _oldestMessageId = messages[messages.length - 1].id;
+  getMessageWallMore().hidden = messages.length < MESSAGE_PAGE_SIZE;
+};
+
+const refreshMessageWall = async () => {
+  const messages = await server.getUserMessagesByEmail(getTargetUserEmail(), {
+    limit: MESSAGE_PAGE_SIZE,
+  });
+
+  getMessageWallList().innerHTML = messages.map(messageHtml).join("<hr />");
+
+  _oldestMessageId = undefined;
+  _newestMessageId = messages.length > 0 ? messages[0].id : 0;
+  updateWallCursor(messages);
+};
+
+/** @param {WallMessage} message */
+const prependMessage = (message) => {
+  const list = getMessageWallList();
+  // Pushed and fetched messages may overlap.
+  if (list.querySelector(`[data-message-id="${message.id}"]`)) return;
 
-  getMessageWallList().innerHTML = messagesHtml;
+  const separator = list.childElementCount > 0 ? "<hr />" : "";
+  list.insertAdjacentHTML("afterbegin", messageHtml(message) + separator);
+  _newestMessageId = Math.max(_newestMessageId ?? 0, message.id);
+};
+
+/** Fetches only the messages posted since the newest one shown. */
+const syncMessageWall = async () => {
+  if (_newestMessageId == undefined) return refreshMessageWall();
+
+  while (true) {
+    const messages = await server.getUserMessagesByEmail(getTargetUserEmail(), {
+      since: _newestMessageId,
+      limit: MESSAGE_PAGE_SIZE,
+    });
+    messages.forEach(prependMessage);
+    if (messages.length < MESSAGE_PAGE_SIZE) break;
+  }
+};
+
+/** Pushed over the socket, only posts to the user's own wall are sent.
+ * @param {WallMessage} message
+ */
+const onNewMessage = (message) => {
+  if (getTargetUserEmail() != _userEmail || _newestMessageId == undefined)
+    return;
+  prependMessage(message);
+};
+
+/** @param {{ id: number, region: string }} update */
+const onMessageUpdated = ({ id, region }) => {
+  const element = getMessageWallList().querySelector(
+    `[data-message-id="${id}"] .message-region`
+  );
+  if (element) element.innerHTML = regionHtml(region);
+};
+
+const loadMoreMessages = async () => {
+  if (_oldestMessageId == undefined) return;
+
+  const messages = await server.getUserMessagesByEmail(getTargetUserEmail(), {
+    before: _oldestMessageId,
+    limit: MESSAGE_PAGE_SIZE,
+  });
+
+  if (messages.length > 0) {
+    getMessageWallList().insertAdjacentHTML(
+      "beforeend",
+      "<hr />" + messages.map(messageHtml).join("<hr />")
+    );
+  }
+  updateWallCursor(messages);
 };
 
 const getMessageWallPostContents = () =>
@@ -144,6 +228,8 @@ const getMessageWallFormServerMessage = () =>
   AsHTMLElement(NonNull(getMessageWallForm().querySelector(".form-message")));
 const getMessageWallRefresh = () =>
   NonNull(document.getElementById("message-wall-refresh"));
+const getMessageWallMore = () =>
+  NonNull(document.getElementById("message-wall-more"));
 
 const onHomeViewRefresh = async () => {
   const userDetails = await server.getUserDataByEmail(getTargetUserEmail());
@@ -159,6 +245,7 @@ const onHomeViewRefresh = async () => {
 
 const onHomeViewLoad = () => {
   getMessageWallRefresh().addEventListener("click", refreshMessageWall);
+  getMessageWallMore().addEventListener("click", loadMoreMessages);
   getMessageWallForm().addEventListener("submit", async (e) => {
     e.preventDefault();
 
@@ -175,7 +262,7 @@ const onHomeViewLoad = () => {
       );
 
       getMessageWallPostContents().value = "";
-      await refreshMessageWall();
+      await syncMessageWall();
     } catch {
       // There are no expected errors here.
       messageWallFormServerMessage.innerText = "An unknown error has occured.";
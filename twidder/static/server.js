@@ -6,8 +6,18 @@
 
 /**
  * @typedef WallMessage
+ * @property {number} id
  * @property {string} author
  * @property {string} contents
+ * @property {string | null} region
+ * @property {number} created
+ */
+
+/**
+ * @typedef WallPage
+ * @property {number} [before] Only messages older than this message id.
+ * @property {number} [since] Only messages newer than this message id, oldest first.
+ * @property {number} [limit]
  */
 
 /**
@@ -55,6 +65,23 @@ function assertServerResponse(obj) {
     return true;
 }
 
+/**
+ * @param {WallPage} [page]
+ * @returns {Record<string, string> | undefined}
+ */
+function wallPageParams(page) {
+    if (page == undefined) return undefined;
+
+    /** @type {Record<string, string>} */
+    const params = {};
+    if (page.before != undefined) params.before = `${page.before}`;
+    if (page.since != undefined) params.since = `${page.since}`;
+    if (page.limit != undefined) params.limit = `${page.limit}`;
+    return params;
+}
+
+const MAX_CACHED_RESPONSES = 100;
+
 class Server {
     /** 
      * @type {string | undefined}
@@ -63,13 +90,20 @@ class Server {
 
     constructor() {}
 
+    /**
+     * Last response of each GET url that came with an ETag, revalidated with If-None-Match.
+     * @type {Map<string, { etag: string, data: any }>}
+     */
+    responseCache = new Map()
+
     /**
      * @param {HttpMethod} method
      * @param {string} url body
      * @param {object} [body]
-     * @returns {Promise<{ text: string, status: number }>}
+     * @param {Record<string, string>} [headers]
+     * @returns {Promise<{ text: string, status: number, etag: string | null }>}
      */
-    async httpRequest(method, url, body) {
+    async httpRequest(method, url, body, headers = {}) {
         const token = this.token
         return await new Promise((resolve, reject) => {
             const xhttp = new XMLHttpRequest();
@@ -77,6 +111,7 @@ class Server {
                 resolve({
                     text: xhttp.responseText,
                     status: xhttp.status,
+                    etag: xhttp.getResponseHeader('ETag'),
                 })
             });
             xhttp.addEventListener('error', () => {
@@ -86,6 +121,7 @@ class Server {
 
             if (body != undefined) xhttp.setRequestHeader('Content-type', 'application/json');
             if (token != undefined) xhttp.setRequestHeader('Authorization', token);
+            Object.entries(headers).forEach(([name, value]) => xhttp.setRequestHeader(name, value));
             xhttp.send(JSON.stringify(body, null, 4));
         });
     };
@@ -119,6 +155,8 @@ class Server {
      */
     setToken(token) {
         this.token = token;
+        // The by_token urls are the same for every user.
+        this.responseCache.clear();
     }
 
     /**
@@ -135,8 +173,18 @@ class Server {
             url += `?${paramList}`;
         }
 
-        const response = await this.httpRequest("GET", url);
-        return this.handleResponse(response);
+        const cached = this.responseCache.get(url);
+        const response = await this.httpRequest("GET", url, undefined, cached ? { 'If-None-Match': cached.etag } : {});
+        if (response.status == 304 && cached) return cached.data;
+
+        const data = await this.handleResponse(response);
+        if (response.etag) {
+            this.responseCache.delete(url);
+            this.responseCache.set(url, { etag: response.etag, data });
+            // Maps iterate in insertion order, drop the oldest entry.
+            if (this.responseCache.size > MAX_CACHED_RESPONSES) this.responseCache.delete(this.responseCache.keys().next().value);
+        }
+        return data;
     }
 
     /**
@@ -192,17 +240,33 @@ class Server {
         this.get(`get_user_data_by_email/${email}`);
 
     /**
+     * @param {WallPage} [page]
      * @returns {Promise<WallMessage[]>} 
      */
-    getUserMessagesByToken = () => 
-        this.get("get_user_messages_by_token");
+    getUserMessagesByToken = (page) => 
+        this.get("get_user_messages_by_token", wallPageParams(page));
 
     /**
      * @param {string} email
+     * @param {WallPage} [page]
      * @returns {Promise<WallMessage[]>} 
      */
-    getUserMessagesByEmail = (email) => 
-        this.get(`get_user_messages_by_email/${email}`);
+    getUserMessagesByEmail = (email, page) => 
+        this.get(`get_user_messages_by_email/${email}`, wallPageParams(page));
+
+    /**
+     * @param {string} q
+     * @param {{ author?: string, recipient?: string, region?: string, limit?: number, offset?: number }} [filters]
+     * @returns {Promise<(WallMessage & { recipient: string })[]>} 
+     */
+    searchMessages = (q, filters = {}) => {
+        /** @type {Record<string, string>} */
+        const params = { q: encodeURIComponent(q) };
+        Object.entries(filters).forEach(([key, value]) => {
+            if (value != undefined) params[key] = encodeURIComponent(`${value}`);
+        });
+        return this.get("search_messages", params);
+    }
 
     /**
      * @param {string} message
@@ -212,6 +276,22 @@ class Server {
      */
     postMessage = (message, coords, email) => 
         this.post("post_message", { message, coords, email }, "POST");
+
+    /**
+     * @param {string} message
+     * @param {{ lat: number, lon: number }} coords
+     * @param {string[]} emails
+     * @returns {Promise<{ email: string, success: boolean, id?: number, message?: string }[]>} 
+     */
+    postMessages = (message, coords, emails) => 
+        this.post("post_messages", { message, coords, emails }, "POST");
+
+    /**
+     * @param {string[]} emails
+     * @returns {Promise<Record<string, { online: boolean, lastSeen: number | null }>>} 
+     */
+    getPresence = (emails) => 
+        this.post("presence", { emails }, "POST");
 }
 
 const server = new Server();
\ No newline at end of file
@@ -16,7 +16,7 @@ function assertSocketResponse(obj) {
 }
 
 /**
- * @typedef {'PING' | 'PONG' | 'LOGOUT' | 'LOGIN'} SocketClientAction
+ * @typedef {'PING' | 'PONG' | 'LOGOUT' | 'LOGIN' | 'SUBSCRIBE_PRESENCE'} SocketClientAction
  */
 
 /**
@@ -26,7 +26,7 @@ function assertSocketResponse(obj) {
  */
 
 /**
- * @typedef {'OPEN' | 'CLOSE' | 'PING' | 'PONG' | 'LOGOUT' | 'LOGGED_IN' | 'NEW_MESSAGE'} SocketServerAction
+ * @typedef {'OPEN' | 'CLOSE' | 'PING' | 'PONG' | 'LOGOUT' | 'LOGGED_IN' | 'NEW_MESSAGE' | 'MESSAGE_UPDATED' | 'BATCH' | 'RESYNC' | 'PRESENCE' | 'ERROR'} SocketServerAction
  */
 
 /**
@@ -70,10 +70,21 @@ class SocketClient {
   /** @type {string | undefined} */
   token = undefined;
 
+  /** @type {string[]} */
+  presenceEmails = [];
+  /** @type {Record<string, { online: boolean, lastSeen: number | null }>} */
+  presence = {};
+
   constructor() {
     this.open();
 
     this.addListener("PING", () => this.sendMessage("PONG"));
+    this.addListener(
+      "BATCH",
+      /** @param {SocketServerMessage[]} messages */
+      (messages) =>
+        messages.forEach(({ action, data }) => this.handleMessage(action, data))
+    );
     this.addListener("OPEN", () => {
       this.isOpen = true;
       console.log("Socket open.");
@@ -98,6 +109,25 @@ class SocketClient {
       console.log("Successfully logged in to websocket.");
       this.isLoggingIn = false;
       this.isLoggedIn = true;
+
+      // Subscriptions don't survive reconnecting.
+      if (this.presenceEmails.length > 0) {
+        this.sendMessage("SUBSCRIBE_PRESENCE", this.presenceEmails);
+      }
+    });
+    this.addListener("ERROR", ({ reason, retryAfter }) => {
+      console.warn(`Socket request refused: ${reason}`);
+
+      // The login was refused, try again once allowed.
+      if (this.isLoggingIn) {
+        this.isLoggingIn = false;
+        setTimeout(() => {
+          if (this.token != undefined) this.login();
+        }, (retryAfter ?? 1) * 1000);
+      }
+    });
+    this.addListener("PRESENCE", (changes) => {
+      Object.assign(this.presence, changes);
     });
   }
 
@@ -257,6 +287,16 @@ class SocketClient {
   logout = () =>
     this.handleMessage("LOGOUT", { reason: "Logged out by user." });
 
+  /**
+   * Replaces the presence subscription, `presence` is kept up to date for these emails.
+   * @param {string[]} emails
+   */
+  subscribePresence(emails) {
+    this.presenceEmails = emails;
+    this.presence = {};
+    if (this.isLoggedIn) this.sendMessage("SUBSCRIBE_PRESENCE", emails);
+  }
+
   login() {
     if (this.token == undefined) throw new Error("Token is undefined.");
     if (!this.isOpen || this.isLoggedIn || this.isLoggingIn) return;
@@ -269,9 +309,17 @@ class SocketClient {
 const socketClient = new SocketClient();
 
 socketClient.addListener("LOGGED_IN", () => {
-  showToast("You are logged in.");
-
   server.setToken(socketClient.token);
+
+  // Reconnected, only catch up on what was missed.
+  if (_currentView == "profile") {
+    try {
+      syncMessageWall();
+    } catch {}
+    return;
+  }
+
+  showToast("You are logged in.");
   setView("profile");
 });
 socketClient.addListener("LOGOUT", ({ reason }) => {
@@ -282,8 +330,20 @@ socketClient.addListener("LOGOUT", ({ reason }) => {
   setView("welcome");
 });
 
-socketClient.addListener("NEW_MESSAGE", () => {
+socketClient.addListener("NEW_MESSAGE", (message) => {
+  try {
+    onNewMessage(message);
+  } catch {}
+});
+
+socketClient.addListener("RESYNC", () => {
   try {
     refreshMessageWall();
   } catch {}
 });
+
+socketClient.addListener("MESSAGE_UPDATED", (update) => {
+  try {
+    onMessageUpdated(update);
+  } catch {}
+});
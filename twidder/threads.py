@@ -0,0 +1,18 @@
+import os
+from typing import Callable
+
+def start_lazily(owner, start: Callable[[], None]):
+    """
+    Calls `start` the first time `owner` needs its background threads in the
+    current process, callers hold their own lock around it.
+
+    No threads may exist before gunicorn forks its workers, and a forked worker
+    only inherits the thread that forked it, so every process starts its own.
+    """
+
+    if started_here(owner): return
+    start()
+    owner._started_pid = os.getpid()
+
+def started_here(owner) -> bool:
+    return getattr(owner, "_started_pid", None) == os.getpid()
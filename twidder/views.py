@@ -1,5 +1,18 @@
 from . import app
+from .assets import AssetStore, asset_response
+
+# Precompressed in memory at startup, served without touching the disk.
+assets = AssetStore(app.static_folder)
+send_static_file = app.view_functions['static']
+
+def static(filename):
+    asset = assets.get(filename)
+    if asset is None:
+        return send_static_file(filename=filename)
+    return asset_response(asset)
+
+app.view_functions['static'] = static
 
 @app.route('/')
 def index():
-    return app.send_static_file("client.html")
+    return asset_response(assets.get("client.html"))
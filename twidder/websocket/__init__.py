@@ -3,4 +3,11 @@ from flask_sock import Sock
 
 sock = Sock(app)
 
+from .bus import bus
+
+@app.before_request
+def start_bus():
+    # Idempotent, starts tailing other workers' events in each forked worker.
+    bus.start()
+
 from . import routes
\ No newline at end of file
@@ -0,0 +1,171 @@
+"""
+Standalone asyncio websocket server speaking the same protocol as `/socket`.
+
+The flask-sock route keeps one HTTP thread blocked per connected client. This
+server instead multiplexes every socket on a single event loop thread, only
+handing LOGIN off to a small thread pool since it touches the database.
+
+    python -m twidder.websocket.async_server
+
+Put it behind the same reverse proxy as gunicorn and route `/socket` to
+TWIDDER_SOCKET_PORT. Both processes must share notifications through the
+SQLite bus (TWIDDER_NOTIFY_BUS=sqlite), start.sh does this when
+TWIDDER_SOCKET_SERVER=async.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from wsproto import ConnectionType, WSConnection
+from wsproto.connection import ConnectionState
+from wsproto.events import AcceptConnection, CloseConnection, Message, Ping, RejectConnection, Request, TextMessage
+
+from twidder.backend.ratelimit import forwarded_ip
+from .bus import LocalBus, bus
+from .lib import ClientAction, parse_client_request
+from .server_socket import ServerSocket
+
+SOCKET_HOST = os.environ.get("TWIDDER_SOCKET_HOST", "127.0.0.1")
+SOCKET_PORT = int(os.environ.get("TWIDDER_SOCKET_PORT", 5001))
+SOCKET_PATH = os.environ.get("TWIDDER_SOCKET_PATH", "/socket")
+SOCKET_WORKERS = int(os.environ.get("TWIDDER_SOCKET_WORKERS", 8))
+SOCKET_BACKLOG = int(os.environ.get("TWIDDER_SOCKET_BACKLOG", 1024))
+# Bytes waiting for a client to read before it is considered stuck and aborted, writes never block the loop.
+SOCKET_MAX_BUFFER = int(os.environ.get("TWIDDER_SOCKET_MAX_BUFFER", 1024 * 1024))
+HANDSHAKE_TIMEOUT = 10
+READ_SIZE = 65536
+
+class AsyncWebSocket:
+    """
+    The part of simple_websocket's interface that ServerSocket uses.
+
+    Bus events are delivered from the bus thread, so every call is forwarded to
+    the event loop unless it already runs on it.
+
+    Writes are buffered by the transport and always succeed, so a client that
+    stopped reading is aborted once more than `SOCKET_MAX_BUFFER` bytes wait
+    for it.
+    """
+
+    closed = False
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, conn: WSConnection, writer: asyncio.StreamWriter):
+        self._loop = loop
+        self._conn = conn
+        self._writer = writer
+
+    def _call(self, func, *args):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self._loop:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def _send(self, text: str):
+        if self.closed or self._conn.state != ConnectionState.OPEN: return
+        self._writer.write(self._conn.send(Message(data=text)))
+        if self._writer.transport.get_write_buffer_size() > SOCKET_MAX_BUFFER:
+            print("Client stopped reading, aborting socket.")
+            self._abort()
+
+    def _close(self):
+        if self.closed: return
+        self.closed = True
+        if self._conn.state == ConnectionState.OPEN:
+            self._writer.write(self._conn.send(CloseConnection(code=1000)))
+        # Also wakes up the read loop with EOF.
+        self._writer.close()
+
+    def _abort(self):
+        if self.closed: return
+        self.closed = True
+        self._writer.transport.abort()
+
+    def send(self, text: str):
+        self._call(self._send, text)
+
+    def close(self):
+        self._call(self._close)
+
+    def abort(self):
+        self._call(self._abort)
+
+def request_ip(event: Request, writer: asyncio.StreamWriter) -> str:
+    route = []
+    for (name, value) in event.extra_headers:
+        if name.lower() == b"x-forwarded-for":
+            route += [address.strip() for address in value.decode("latin-1").split(",")]
+    return forwarded_ip(route, writer.get_extra_info("peername")[0])
+
+async def handle(executor: ThreadPoolExecutor, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    loop = asyncio.get_running_loop()
+    conn = WSConnection(ConnectionType.SERVER)
+    ws = AsyncWebSocket(loop, conn, writer)
+    server_socket: ServerSocket | None = None
+    text: list[str] = []
+
+    try:
+        while server_socket == None or not server_socket.closed:
+            try:
+                # Liveness is handled by the heartbeat once connected.
+                data = await asyncio.wait_for(reader.read(READ_SIZE), HANDSHAKE_TIMEOUT if server_socket == None else None)
+            except TimeoutError:
+                break
+
+            if len(data) == 0: break
+            conn.receive_data(data)
+
+            for event in conn.events():
+                if isinstance(event, Request):
+                    if event.target.split("?")[0] != SOCKET_PATH:
+                        writer.write(conn.send(RejectConnection(status_code=404)))
+                        return
+                    writer.write(conn.send(AcceptConnection()))
+                    server_socket = ServerSocket(ws, request_ip(event, writer))
+                elif isinstance(event, TextMessage):
+                    text.append(event.data)
+                    if not event.message_finished: continue
+
+                    req = parse_client_request("".join(text))
+                    text.clear()
+                    if req.message.action == ClientAction.LOGIN:
+                        # Looks up the session, keep the loop free while it does.
+                        await loop.run_in_executor(executor, server_socket.recv, req)
+                    else:
+                        server_socket.recv(req)
+                elif isinstance(event, Ping):
+                    writer.write(conn.send(event.response()))
+                elif isinstance(event, CloseConnection):
+                    if conn.state == ConnectionState.REMOTE_CLOSING:
+                        writer.write(conn.send(event.response()))
+                    return
+    except Exception as e:
+        print(e)
+    finally:
+        if server_socket != None and not server_socket.closed:
+            server_socket.close()
+        ws.close()
+
+async def serve(host: str, port: int):
+    executor = ThreadPoolExecutor(SOCKET_WORKERS, thread_name_prefix="socket")
+    server = await asyncio.start_server(
+        lambda reader, writer: handle(executor, reader, writer),
+        host, port, backlog=SOCKET_BACKLOG,
+    )
+    print(f"Websocket server listening on {host}:{port}{SOCKET_PATH}.")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    if isinstance(bus, LocalBus):
+        print("Warning: TWIDDER_NOTIFY_BUS is local, notifications from the HTTP workers won't reach this server.")
+    bus.start()
+    asyncio.run(serve(SOCKET_HOST, SOCKET_PORT))
+
+if __name__ == "__main__":
+    main()
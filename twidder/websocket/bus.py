@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable
+
+from twidder.backend.pool import ConnectionPool
+from twidder.threads import start_lazily, started_here
+
+NOTIFY_BUS = os.environ.get("TWIDDER_NOTIFY_BUS", "local")
+EVENTS_PATH = os.environ.get("TWIDDER_EVENTS_DB", "events.db")
+POLL_INTERVAL = float(os.environ.get("TWIDDER_EVENTS_POLL_INTERVAL", 0.05))
+# Workers only tail new events, old ones are just kept long enough for slow pollers.
+EVENTS_RETENTION = float(os.environ.get("TWIDDER_EVENTS_RETENTION", 60))
+
+# Internal action, tells every worker to drop a signed out token (data) from its session cache.
+SESSION_REVOKED = "SESSION_REVOKED"
+# Internal action, tells every worker to drop a user (data is the email) from its user cache.
+USER_CHANGED = "USER_CHANGED"
+# Internal action, a user (recipient) logged in or their socket closed, data is { "online", "at" }.
+PRESENCE_CHANGED = "PRESENCE_CHANGED"
+
+class Event:
+    action: str
+    recipient: str
+    data: Any
+    # A socket logged in with this token is skipped.
+    except_token: str | None
+
+    def __init__(self, action: str, recipient: str, data: Any = None, except_token: str | None = None):
+        self.action = action
+        self.recipient = recipient
+        self.data = data
+        self.except_token = except_token
+
+class NotificationBus:
+    """
+    Delivers events to every worker process, each subscriber then decides what
+    to do with them, e.g. forward them to its own websockets.
+    """
+
+    def __init__(self):
+        self._handlers: list[Callable[[Event], None]] = []
+
+    def subscribe(self, handler: Callable[[Event], None]):
+        self._handlers.append(handler)
+
+    def _dispatch(self, event: Event):
+        for handler in self._handlers:
+            try:
+                handler(event)
+            except Exception as err:
+                print(err)
+
+    def start(self):
+        pass
+
+    def publish(self, event: Event):
+        raise NotImplementedError
+
+    def publish_many(self, events: list[Event]):
+        for event in events:
+            self.publish(event)
+
+class LocalBus(NotificationBus):
+    """
+    Single process bus, events are dispatched right away on the publishing thread.
+    """
+
+    def publish(self, event: Event):
+        self._dispatch(event)
+
+class SQLiteBus(NotificationBus):
+    """
+    Event log in a SQLite file shared by all workers on the machine.
+
+    Events are dispatched locally right away and appended to the log, every
+    worker tails the log every `poll_interval` seconds and dispatches the events
+    published by the other workers.
+    """
+
+    path: str
+    poll_interval: float
+    retention: float
+    origin: str
+
+    def __init__(self, path: str, poll_interval: float, retention: float):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+
+        self._pool = ConnectionPool(path, 4, 10, self._create_table)
+        self._lock = threading.Lock()
+
+    def _create_table(self, con):
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS Event (
+                Id INTEGER PRIMARY KEY AUTOINCREMENT,
+                Origin TEXT NOT NULL,
+                Action TEXT NOT NULL,
+                Recipient TEXT NOT NULL,
+                Data TEXT,
+                ExceptToken TEXT,
+                Created REAL NOT NULL
+            )
+        """)
+
+    def start(self):
+        """
+        Starts tailing the log, must be called in every worker after forking.
+        """
+
+        # Called on every publish, skip the lock once running.
+        if started_here(self): return
+        with self._lock:
+            start_lazily(self, self._start_tailing)
+
+    def _start_tailing(self):
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex}"
+
+        with self._pool.connection() as con:
+            (self._last_id,) = con.execute("SELECT COALESCE(MAX(Id), 0) FROM Event").fetchone()
+
+        threading.Thread(target=self._tail, name="notification-bus", daemon=True).start()
+
+    def publish(self, event: Event):
+        self.start()
+        self._dispatch(event)
+
+        self._append([event])
+
+    def publish_many(self, events: list[Event]):
+        """
+        Appends every event to the log in one transaction.
+        """
+
+        self.start()
+        for event in events:
+            self._dispatch(event)
+        self._append(events)
+
+    def _append(self, events: list[Event]):
+        now = time.time()
+        with self._pool.connection() as con:
+            con.executemany("INSERT INTO Event (Origin, Action, Recipient, Data, ExceptToken, Created) VALUES (?, ?, ?, ?, ?, ?)", [(
+                self.origin,
+                str(event.action),
+                event.recipient,
+                json.dumps(event.data),
+                event.except_token,
+                now,
+            ) for event in events])
+
+    def _poll(self) -> list[Event]:
+        with self._pool.connection() as con:
+            res = con.execute("SELECT Id, Origin, Action, Recipient, Data, ExceptToken FROM Event WHERE Id > ? ORDER BY Id", (self._last_id,))
+            rows = res.fetchall()
+
+        events = []
+        for (id, origin, action, recipient, data, except_token) in rows:
+            self._last_id = id
+            if origin != self.origin:
+                events.append(Event(action, recipient, json.loads(data), except_token))
+        return events
+
+    def _prune(self):
+        with self._pool.connection() as con:
+            con.execute("DELETE FROM Event WHERE Created < ?", (time.time() - self.retention,))
+
+    def _tail(self):
+        last_prune = time.monotonic()
+        while True:
+            try:
+                for event in self._poll():
+                    self._dispatch(event)
+
+                if time.monotonic() - last_prune > self.retention:
+                    last_prune = time.monotonic()
+                    self._prune()
+            except Exception as err:
+                print(err)
+
+            time.sleep(self.poll_interval)
+
+def create_bus() -> NotificationBus:
+    if NOTIFY_BUS == "local":
+        return LocalBus()
+    if NOTIFY_BUS == "sqlite":
+        return SQLiteBus(EVENTS_PATH, POLL_INTERVAL, EVENTS_RETENTION)
+    raise Exception(f"Unknown notification bus {NOTIFY_BUS}.")
+
+bus = create_bus()
@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+from typing import Any
+
+from twidder.backend.metrics import stats_gauges
+from twidder.threads import start_lazily
+from .lib import ServerAction
+
+HEARTBEAT_INTERVAL = float(os.environ.get("TWIDDER_HEARTBEAT_INTERVAL", 30))
+# Sockets that haven't sent anything for this long are evicted.
+HEARTBEAT_TIMEOUT = float(os.environ.get("TWIDDER_HEARTBEAT_TIMEOUT", 75))
+HEARTBEAT_SLOTS = int(os.environ.get("TWIDDER_HEARTBEAT_SLOTS", 30))
+
+class HeartbeatScheduler:
+    """
+    Keeps track of the liveness of every socket from a single thread.
+
+    Sockets are spread over a timing wheel of `slots` buckets and the wheel
+    advances one bucket every `interval / slots` seconds, so each socket is
+    visited once per interval and the PINGs go out in small batches. A visited
+    socket that has been quiet for `interval` gets a PING, one that has been
+    quiet for `timeout` is aborted.
+
+    The wheel thread never writes to a socket itself, a client that stopped
+    reading would hold up every other socket. PINGs are queued on the
+    socket's outbox and aborting doesn't wait for the client.
+
+    Sockets need a `last_seen` (time.monotonic()) and `closed` attribute and
+    `notify(action)` and `abort()` methods, see ServerSocket.
+    """
+
+    interval: float
+    timeout: float
+    slots: int
+
+    opened: int = 0
+    closed: int = 0
+    evicted: int = 0
+    pings: int = 0
+
+    def __init__(self, interval: float, timeout: float, slots: int):
+        self.interval = interval
+        self.timeout = timeout
+        self.slots = slots
+
+        self._wheel: list[set] = [set() for _ in range(slots)]
+        # Socket -> index of its slot in the wheel.
+        self._slot_of: dict[Any, int] = {}
+        self._cursor = 0
+        self._lock = threading.Lock()
+
+    @property
+    def tick(self) -> float:
+        return self.interval / self.slots
+
+    def add(self, socket):
+        with self._lock:
+            start_lazily(self, self._start)
+
+            # The slot just behind the cursor, first visited a full interval from now.
+            slot = (self._cursor - 1) % self.slots
+            self._wheel[slot].add(socket)
+            self._slot_of[socket] = slot
+            self.opened += 1
+
+    def _start(self):
+        threading.Thread(target=self._run, name="heartbeat", daemon=True).start()
+
+    def remove(self, socket):
+        with self._lock:
+            slot = self._slot_of.pop(socket, None)
+            if slot == None: return
+            self._wheel[slot].discard(socket)
+            self.closed += 1
+
+    def _advance(self, now: float) -> tuple[list, list]:
+        to_ping = []
+        to_evict = []
+        with self._lock:
+            for socket in self._wheel[self._cursor]:
+                if socket.closed: continue
+
+                idle = now - socket.last_seen
+                if idle >= self.timeout:
+                    to_evict.append(socket)
+                # Slack for the wheel's resolution, otherwise quiet sockets would only be pinged every other turn.
+                elif idle >= self.interval - self.tick:
+                    to_ping.append(socket)
+            self._cursor = (self._cursor + 1) % self.slots
+        return (to_ping, to_evict)
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            time.sleep(max(0, next_tick - time.monotonic()))
+            next_tick += self.tick
+
+            (to_ping, to_evict) = self._advance(time.monotonic())
+            for socket in to_evict:
+                print("Evicting unresponsive socket.")
+                try:
+                    socket.abort()
+                except Exception as err:
+                    print(err)
+                # abort() normally removes it, make sure it is gone either way.
+                self.remove(socket)
+                with self._lock:
+                    self.evicted += 1
+
+            for socket in to_ping:
+                try:
+                    socket.notify(ServerAction.PING)
+                except Exception as err:
+                    print(err)
+            with self._lock:
+                self.pings += len(to_ping)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "connected": len(self._slot_of),
+                "opened": self.opened,
+                "closed": self.closed,
+                "evicted": self.evicted,
+                "pings": self.pings,
+            }
+
+heartbeat = HeartbeatScheduler(HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, HEARTBEAT_SLOTS)
+stats_gauges("twidder_heartbeat", "Websocket heartbeat", heartbeat.stats)
@@ -22,6 +22,7 @@ class ClientAction(StrEnum):
     PING = "PING"
     PONG = "PONG"
     LOGIN = "LOGIN"
+    SUBSCRIBE_PRESENCE = "SUBSCRIBE_PRESENCE"
 
 class ClientMessage:
     action: ClientAction
@@ -56,4 +57,13 @@ class ServerAction(StrEnum):
     PONG = "PONG"
     LOGGED_IN = "LOGGED_IN"
     LOGOUT = "LOGOUT"
-    NEW_MESSAGE = "NEW_MESSAGE"
\ No newline at end of file
+    NEW_MESSAGE = "NEW_MESSAGE"
+    MESSAGE_UPDATED = "MESSAGE_UPDATED"
+    # Several notifications in one frame, data is a list of { action, data }.
+    BATCH = "BATCH"
+    # Notifications were dropped, the client should refetch.
+    RESYNC = "RESYNC"
+    # Online status by email, everything subscribed to at first, then only changes.
+    PRESENCE = "PRESENCE"
+    # Answers a request that was refused, data is { reason, retryAfter? }.
+    ERROR = "ERROR"
\ No newline at end of file
@@ -0,0 +1,219 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Hashable
+
+from twidder.backend.metrics import counter, gauge
+from twidder.threads import start_lazily
+from .lib import ServerAction
+
+# Notifications arriving within this many seconds of each other share a frame.
+OUTBOX_WINDOW = float(os.environ.get("TWIDDER_OUTBOX_WINDOW", 0.02))
+# More pending notifications than this and the client is told to resync instead.
+OUTBOX_MAX_QUEUE = int(os.environ.get("TWIDDER_OUTBOX_MAX_QUEUE", 256))
+# Overflowing this many times without catching up in between gets the socket aborted.
+OUTBOX_MAX_OVERFLOWS = int(os.environ.get("TWIDDER_OUTBOX_MAX_OVERFLOWS", 3))
+OUTBOX_WRITERS = int(os.environ.get("TWIDDER_OUTBOX_WRITERS", 4))
+
+outbox_events = counter("twidder_outbox_events_total", "Websocket notifications by outcome (sent, collapsed, dropped).")
+outbox_frames = counter("twidder_outbox_frames_total", "Websocket notification frames written.")
+outbox_aborts = counter("twidder_outbox_aborted_total", "Websockets aborted because their outbox kept overflowing.")
+
+def notification_key(action: ServerAction, data: Any) -> Hashable:
+    """
+    Notifications with the same key are duplicates, only the latest is sent.
+    """
+
+    if isinstance(data, dict) and "id" in data:
+        return (action, data["id"])
+    return (action, repr(data))
+
+class Outbox:
+    """
+    Notifications waiting to be sent to one socket.
+
+    At most one flush per outbox is scheduled or running at a time, so frames
+    go out in order, and a slow client only holds up its own notifications.
+
+    Sends aren't bounded, a client that stops reading blocks its flush. Its
+    notifications keep piling up meanwhile, every `max_queue` of them count as
+    an overflow and after `max_overflows` without a flush getting through the
+    socket is aborted, which also fails the stuck send. A client that neither
+    reads nor writes is aborted by the heartbeat before that.
+    """
+
+    def __init__(self, socket, writer: "OutboxWriter", max_queue: int, max_overflows: int):
+        self.socket = socket
+        self.max_queue = max_queue
+        self.max_overflows = max_overflows
+
+        self._writer = writer
+        # Insertion ordered, a duplicate replaces the queued notification in place.
+        self._pending: dict[Hashable, tuple[ServerAction, Any]] = {}
+        self._overflowed = False
+        # Overflows since a flush last got through, and notifications dropped since the last one.
+        self._overflows = 0
+        self._dropped = 0
+        # (action, data) sent last before the socket is closed, see close().
+        self._last: tuple[ServerAction, Any] | None = None
+        self._closing = False
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def _overflow(self) -> bool:
+        # Must hold the lock, returns whether the socket should be aborted.
+        self._overflowed = True
+        self._overflows += 1
+        self._dropped = 0
+        if self._overflows < self.max_overflows or self._closing: return False
+        self._closing = True
+        return True
+
+    def put(self, action: ServerAction, data: Any = None):
+        abort = False
+        with self._lock:
+            key = notification_key(action, data)
+            if self._closing:
+                outbox_events.inc(outcome="dropped")
+                return
+            elif self._overflowed:
+                outbox_events.inc(outcome="dropped")
+                self._dropped += 1
+                if self._dropped >= self.max_queue:
+                    abort = self._overflow()
+            elif key in self._pending:
+                self._pending[key] = (action, data)
+                outbox_events.inc(outcome="collapsed")
+            elif len(self._pending) >= self.max_queue:
+                # The client is falling behind, it refetches instead of getting every event.
+                outbox_events.inc(len(self._pending) + 1, outcome="dropped")
+                self._pending.clear()
+                abort = self._overflow()
+            else:
+                self._pending[key] = (action, data)
+
+            schedule = not self._scheduled
+            self._scheduled = True
+
+        if abort:
+            print("Outbox keeps overflowing, aborting socket.")
+            outbox_aborts.inc()
+            self.socket.abort()
+        elif schedule:
+            self._writer.schedule(self)
+
+    def close(self, action: ServerAction | None = None, data: Any = None):
+        """
+        Sends the queued notifications, then `action` if given, then closes the
+        socket. Later notifications are dropped.
+        """
+
+        with self._lock:
+            if self._closing: return
+            self._closing = True
+            if action != None:
+                self._last = (action, data)
+
+            schedule = not self._scheduled
+            self._scheduled = True
+
+        if schedule:
+            self._writer.schedule(self)
+
+    def flush(self):
+        with self._lock:
+            events = list(self._pending.values())
+            self._pending.clear()
+            if self._overflowed:
+                # Not worth catching up on when the socket is about to close anyway.
+                events = [] if self._closing else [(ServerAction.RESYNC, None)]
+                self._overflowed = False
+            if self._last != None:
+                events.append(self._last)
+                self._last = None
+            close = self._closing
+
+        try:
+            if len(events) > 0 and not self.socket.closed:
+                if len(events) == 1:
+                    self.socket.send(*events[0])
+                else:
+                    self.socket.send(ServerAction.BATCH, [{ "action": action, "data": data } for (action, data) in events])
+                outbox_events.inc(len(events), outcome="sent")
+                outbox_frames.inc()
+            with self._lock:
+                self._overflows = 0
+        except Exception as err:
+            print(err)
+        finally:
+            if close and not self.socket.closed:
+                try:
+                    self.socket.close()
+                except Exception as err:
+                    print(err)
+
+            with self._lock:
+                again = not close and (len(self._pending) > 0 or self._overflowed)
+                self._scheduled = again
+
+            if again:
+                self._writer.schedule(self)
+
+class OutboxWriter:
+    """
+    Flushes outboxes `window` seconds after they were scheduled, on a small
+    thread pool so request and bus threads never wait on a client's socket.
+    """
+
+    window: float
+    workers: int
+
+    def __init__(self, window: float, workers: int):
+        self.window = window
+        self.workers = workers
+
+        # (deadline, outbox), every outbox waits the same window so this stays sorted.
+        self._due: deque[tuple[float, Outbox]] = deque()
+        self._cond = threading.Condition()
+        self._executor: ThreadPoolExecutor | None = None
+
+    def _start(self):
+        # Outboxes scheduled before a fork belong to the parent's sockets.
+        self._due.clear()
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="outbox")
+        threading.Thread(target=self._run, name="outbox", daemon=True).start()
+
+    def schedule(self, outbox: Outbox):
+        with self._cond:
+            start_lazily(self, self._start)
+
+            self._due.append((time.monotonic() + self.window, outbox))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._due:
+                        remaining = self._due[0][0] - time.monotonic()
+                        if remaining <= 0: break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+
+                now = time.monotonic()
+                ready = []
+                while self._due and self._due[0][0] <= now:
+                    ready.append(self._due.popleft()[1])
+
+            for outbox in ready:
+                self._executor.submit(outbox.flush)
+
+    def scheduled(self) -> int:
+        with self._cond:
+            return len(self._due)
+
+outbox_writer = OutboxWriter(OUTBOX_WINDOW, OUTBOX_WRITERS)
+gauge("twidder_outbox_scheduled", "Websocket outboxes waiting for their batching window.", outbox_writer.scheduled)
@@ -0,0 +1,214 @@
+import os
+import threading
+import time
+from typing import Any
+
+from twidder.backend.metrics import stats_gauges
+from twidder.threads import start_lazily
+from .bus import PRESENCE_CHANGED, Event, bus
+from .lib import ServerAction
+
+# Each socket process re-announces its logged in users this often...
+PRESENCE_REFRESH_INTERVAL = float(os.environ.get("TWIDDER_PRESENCE_REFRESH_INTERVAL", 30))
+# ...and users not announced for this long are offline, e.g. when their worker died.
+PRESENCE_TTL = float(os.environ.get("TWIDDER_PRESENCE_TTL", 90))
+# Presence changes within this many seconds reach subscribers as one diff.
+PRESENCE_DEBOUNCE = float(os.environ.get("TWIDDER_PRESENCE_DEBOUNCE", 1))
+
+def presence_dict(state: tuple[bool, float] | None) -> dict[str, Any]:
+    if state == None:
+        return { "online": False, "lastSeen": None }
+    (online, last_seen) = state
+    return { "online": online, "lastSeen": int(last_seen) }
+
+class PresenceIndex:
+    """
+    Who is logged in on a websocket, in any worker, and when everyone else
+    was last seen.
+
+    Sockets report their own logins and closes, which are shared over the bus
+    so every worker keeps the same index. Lookups are a dict access per email.
+
+    Sockets may subscribe to a list of emails, changes are collected for
+    `debounce` seconds and pushed as one PRESENCE notification, leaving out
+    users who went offline and came back within that time.
+    """
+
+    refresh_interval: float
+    ttl: float
+    debounce: float
+
+    def __init__(self, refresh_interval: float, ttl: float, debounce: float):
+        self.refresh_interval = refresh_interval
+        self.ttl = ttl
+        self.debounce = debounce
+
+        # Email -> (online, time.time() it was last announced online or went offline)
+        self._states: dict[str, tuple[bool, float]] = {}
+        # Users logged in on this process's sockets.
+        self._local: set[str] = set()
+        # Socket -> { email -> online as last sent to it }
+        self._subscriptions: dict[Any, dict[str, bool]] = {}
+        # Email -> sockets subscribed to it
+        self._watchers: dict[str, set[Any]] = {}
+        # Socket -> emails changed since its last diff
+        self._pending: dict[Any, set[str]] = {}
+        self._flush_at = 0.0
+        self._cond = threading.Condition()
+
+    def _start(self):
+        # Only processes with sockets need to refresh and push.
+        threading.Thread(target=self._run, name="presence", daemon=True).start()
+
+    def _is_online(self, state: tuple[bool, float] | None, now: float) -> bool:
+        return state != None and state[0] and now - state[1] < self.ttl
+
+    def _set(self, email: str, online: bool, at: float):
+        # Must hold the lock.
+        state = self._states.get(email)
+        if state != None and state[1] > at: return
+        was_online = self._is_online(state, at)
+        self._states[email] = (online, at)
+
+        if online != was_online:
+            for socket in self._watchers.get(email, ()):
+                self._pending.setdefault(socket, set()).add(email)
+            if self._pending and self._flush_at == 0:
+                self._flush_at = time.monotonic() + self.debounce
+                self._cond.notify()
+
+    def apply(self, email: str, online: bool, at: float):
+        with self._cond:
+            self._set(email, online, at)
+
+    def connected(self, email: str):
+        with self._cond:
+            start_lazily(self, self._start)
+            self._local.add(email)
+        bus.publish(Event(PRESENCE_CHANGED, email, { "online": True, "at": time.time() }))
+
+    def disconnected(self, email: str):
+        with self._cond:
+            self._local.discard(email)
+        bus.publish(Event(PRESENCE_CHANGED, email, { "online": False, "at": time.time() }))
+
+    def moved(self, email: str):
+        """
+        The user's socket here was replaced by a login elsewhere, they stay
+        online but this process stops announcing them.
+        """
+
+        with self._cond:
+            self._local.discard(email)
+
+    def lookup(self, emails: list[str]) -> dict[str, dict[str, Any]]:
+        now = time.time()
+        with self._cond:
+            result = {}
+            for email in emails:
+                state = self._states.get(email)
+                if state != None and state[0] and not self._is_online(state, now):
+                    # Expired, last seen when it was last announced.
+                    state = (False, state[1])
+                result[email] = presence_dict(state)
+            return result
+
+    def subscribe(self, socket, emails: list[str]) -> dict[str, dict[str, Any]]:
+        """
+        Replaces `socket`'s subscription, returns the current presence of `emails`.
+        """
+
+        self.unsubscribe(socket)
+        snapshot = self.lookup(emails)
+        with self._cond:
+            start_lazily(self, self._start)
+            self._subscriptions[socket] = { email: snapshot[email]["online"] for email in emails }
+            for email in emails:
+                self._watchers.setdefault(email, set()).add(socket)
+        return snapshot
+
+    def unsubscribe(self, socket):
+        with self._cond:
+            self._pending.pop(socket, None)
+            for email in self._subscriptions.pop(socket, {}):
+                watchers = self._watchers.get(email)
+                if watchers == None: continue
+                watchers.discard(socket)
+                if not watchers:
+                    del self._watchers[email]
+
+    def _flush(self):
+        now = time.time()
+        with self._cond:
+            pending = self._pending
+            self._pending = {}
+            self._flush_at = 0
+
+            diffs = []
+            for (socket, emails) in pending.items():
+                sent = self._subscriptions.get(socket)
+                if sent == None: continue
+
+                diff = {}
+                for email in emails:
+                    state = self._states.get(email)
+                    # Flapped back within the window, nothing to tell.
+                    if self._is_online(state, now) == sent.get(email): continue
+                    diff[email] = presence_dict((self._is_online(state, now), state[1]))
+                    sent[email] = diff[email]["online"]
+                if diff:
+                    diffs.append((socket, diff))
+
+        for (socket, diff) in diffs:
+            socket.notify(ServerAction.PRESENCE, diff)
+
+    def _refresh(self):
+        now = time.time()
+        with self._cond:
+            local = list(self._local)
+            # Online users nobody announced in time, their process is gone.
+            for (email, (online, at)) in list(self._states.items()):
+                if online and email not in self._local and now - at >= self.ttl:
+                    self._set(email, False, at)
+
+        if local:
+            bus.publish_many([Event(PRESENCE_CHANGED, email, { "online": True, "at": now }) for email in local])
+
+    def _run(self):
+        next_refresh = time.monotonic() + self.refresh_interval
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    deadline = next_refresh if self._flush_at == 0 else min(next_refresh, self._flush_at)
+                    if now >= deadline: break
+                    self._cond.wait(deadline - now)
+                flush = self._flush_at != 0 and now >= self._flush_at
+
+            try:
+                if flush:
+                    self._flush()
+                if now >= next_refresh:
+                    next_refresh = now + self.refresh_interval
+                    self._refresh()
+            except Exception as err:
+                print(err)
+
+    def stats(self) -> dict[str, int]:
+        now = time.time()
+        with self._cond:
+            return {
+                "online": sum(1 for state in self._states.values() if self._is_online(state, now)),
+                "local": len(self._local),
+                "tracked": len(self._states),
+                "subscribers": len(self._subscriptions),
+            }
+
+presence = PresenceIndex(PRESENCE_REFRESH_INTERVAL, PRESENCE_TTL, PRESENCE_DEBOUNCE)
+stats_gauges("twidder_presence", "Websocket presence", presence.stats)
+
+def on_presence_changed(event: Event):
+    if event.action == PRESENCE_CHANGED:
+        presence.apply(event.recipient, event.data["online"], event.data["at"])
+
+bus.subscribe(on_presence_changed)
@@ -1,29 +1,52 @@
+import socket as _socket
+
+from simple_websocket import ConnectionClosed
+
+from twidder.backend.ratelimit import client_ip
 from twidder.websocket.server_socket import ServerSocket
-from .lib import ServerAction, parse_client_request
+from .lib import parse_client_request
 from . import sock
 
+class ThreadedWebSocket:
+    """
+    Lets other threads (the heartbeat evicting the socket) close or abort it while the
+    route's thread is blocked in `receive()`.
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+
+    def send(self, text: str):
+        self.ws.send(text)
+
+    def close(self):
+        try:
+            self.ws.close()
+        except ConnectionClosed:
+            pass
+        # Wakes up receive(), which then raises ConnectionClosed.
+        self.ws.event.set()
+
+    def abort(self):
+        # A close frame could block on a client that stopped reading, shutting the
+        # socket down also fails any send stuck on it.
+        try:
+            self.ws.sock.shutdown(_socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.ws.event.set()
+
 @sock.route('/socket')
 def socket(ws):
-    server_socket = ServerSocket(ws)
+    # Liveness is handled by the heartbeat, the thread only wakes up for requests.
+    server_socket = ServerSocket(ThreadedWebSocket(ws), client_ip())
     try:
-        while True:
-            if server_socket.closed:
-                print("server_socket.closed")
-                break
-            
-            if server_socket.timeout_count >= 2:
-                print("server_socket.timeout_count >= 2")
-                break
-
-            req_text = ws.receive(30)
-            if req_text == None:
-                server_socket.timeout_count += 1
-                server_socket.send(ServerAction.PING)
-            else:
-                req = parse_client_request(req_text)
-                server_socket.recv(req)
+        while not server_socket.closed:
+            req_text = ws.receive()
+            req = parse_client_request(req_text)
+            server_socket.recv(req)
     except Exception as e:
         print(e)
     finally:
         if not server_socket.closed:
-            server_socket.close()
\ No newline at end of file
+            server_socket.close()
@@ -1,12 +1,23 @@
 import json
+import math
+import threading
+import time
 from typing import Any
 
 from twidder.backend import database_helper
+from twidder.backend.lib import MAX_PRESENCE_EMAILS
+from twidder.backend.metrics import gauge
+from twidder.backend.ratelimit import socket_limiter
+from .bus import SESSION_REVOKED, Event, bus
+from .heartbeat import heartbeat
 from .lib import ClientAction, ClientRequest, ServerAction
+from .outbox import OUTBOX_MAX_OVERFLOWS, OUTBOX_MAX_QUEUE, Outbox, outbox_writer
+from .presence import presence
 
 class ServerSocket:
     closed = False
-    timeout_count = 0
+    # time.monotonic() of the last request, read by the heartbeat.
+    last_seen: float
 
     msg_id: int = None
     action: ClientAction
@@ -16,19 +27,50 @@ class ServerSocket:
     email = None
     logged_in = False
 
-    def __init__(self, ws) -> None:
+    def __init__(self, ws, address: str) -> None:
         self.ws = ws
+        # Client address, rate limits key on it until LOGIN.
+        self.address = address
+        self.last_seen = time.monotonic()
+        # The heartbeat and bus threads send too.
+        self._send_lock = threading.Lock()
+        self.outbox = Outbox(self, outbox_writer, OUTBOX_MAX_QUEUE, OUTBOX_MAX_OVERFLOWS)
+        heartbeat.add(self)
 
-    def close(self):
-        print("Closing ServerSocket.")
-        if self.email != None and self.email in activeConnections:
+    def _forget(self):
+        if self.email != None and activeConnections.get(self.email) is self:
             del activeConnections[self.email]
-        self.ws.close()
+            presence.disconnected(self.email)
+        presence.unsubscribe(self)
+        heartbeat.remove(self)
         self.closed = True
 
+    def close(self):
+        self._forget()
+        # The close frame must not land in the middle of a frame the outbox is writing.
+        with self._send_lock:
+            self.ws.close()
+
+    def abort(self):
+        """
+        Drops the connection without a close frame, never waits for the client.
+        """
+
+        self._forget()
+        # Not under the send lock, aborting is how a send stuck on the client is failed.
+        self.ws.abort()
+
     def recv(self, req: ClientRequest):
+        self.last_seen = time.monotonic()
         self.msg_id, msg = req.id, req.message
         self.action, self.data = msg.action, msg.data
+
+        # A flooding client only loses its own requests, it stays alive since last_seen was updated.
+        # Keyed on the address before LOGIN, reconnecting must not give a fresh bucket.
+        wait = socket_limiter.acquire(self.email if self.logged_in else self.address)
+        if wait > 0:
+            self.sendResponse(ServerAction.ERROR, { "reason": "Too many requests, try again later.", "retryAfter": math.ceil(wait) })
+            return
         
         if self.action == ClientAction.PING:
             self.onPing()
@@ -45,27 +87,44 @@ class ServerSocket:
             # Return an error?
             print("Not logged in.")
             self.close()
+            return
+
+        if self.action == ClientAction.SUBSCRIBE_PRESENCE:
+            self.onSubscribePresence()
+            return
         
         print(f"Unhandled client action {self.action}")
         
+    def write(self, text: str):
+        with self._send_lock:
+            self.ws.send(text)
+
     def send(self, action: ServerAction, data: Any = None):
-        self.ws.send(json.dumps({
+        self.write(json.dumps({
             "action": action,
             "data": data
         }))
         
     def sendResponse(self, action: ServerAction, data: Any = None):
-        self.ws.send(json.dumps({
+        self.write(json.dumps({
             "clientId": self.msg_id,
             "action": action,
             "data": data
         }))
         
+    def notify(self, action: ServerAction, data: Any = None):
+        """
+        Queues a notification, it is sent shortly after, possibly batched with others.
+        """
+
+        self.outbox.put(action, data)
+
     def onPing(self):
         self.send(ServerAction.PONG, self.data)
 
     def onPong(self):
-        self.timeout_count = 0
+        # last_seen is already updated by recv.
+        pass
 
     def onLogin(self):
         if self.logged_in:
@@ -81,16 +140,56 @@ class ServerSocket:
             self.send(ServerAction.LOGOUT, { "reason": "Token is not associated with any user." })
             return
         
-        # Logout other clients.
-        oldClient = activeConnections.get(self.email)
-        if oldClient != None and oldClient.token != self.token:
-            print(self.token)
-            print("You logged in at another location.")
-            oldClient.send(ServerAction.LOGOUT, { "reason": "You logged in at another location." })
+        # Logout other clients, they may be connected to another worker.
+        bus.publish(Event(ServerAction.LOGOUT, self.email, { "reason": "You logged in at another location." }, except_token=self.token))
+        # And end their sessions, every worker drops them from its session cache.
+        for token in database_helper.delete_other_sessions(self.email, self.token):
+            bus.publish(Event(SESSION_REVOKED, self.email, token))
 
         self.logged_in = True
         self.sendResponse(ServerAction.LOGGED_IN)
         activeConnections[self.email] = self
+        presence.connected(self.email)
+
+    def onSubscribePresence(self):
+        emails = self.data
+        if not isinstance(emails, list) or not all(isinstance(email, str) for email in emails):
+            raise Exception("Malformed request.")
+
+        emails = list(dict.fromkeys(emails))[:MAX_PRESENCE_EMAILS]
+        self.sendResponse(ServerAction.PRESENCE, presence.subscribe(self, emails))
 
 # Email -> ServerSocket
-activeConnections: dict[str, ServerSocket] = {}
\ No newline at end of file
+activeConnections: dict[str, ServerSocket] = {}
+gauge("twidder_websocket_connections", "Logged in websocket connections.", lambda: len(activeConnections))
+
+def deliver(event: Event):
+    """
+    Forwards bus events to the recipient's socket, if it is connected to this worker.
+    """
+
+    try:
+        action = ServerAction(event.action)
+    except ValueError:
+        # Internal event, nothing to forward.
+        return
+
+    client = activeConnections.get(event.recipient)
+    if client == None or (event.except_token != None and client.token == event.except_token):
+        return
+
+    if action == ServerAction.LOGOUT:
+        print("You logged in at another location.")
+        client.logged_in = False
+        if activeConnections.get(event.recipient) is client:
+            del activeConnections[event.recipient]
+            # close() won't report it offline anymore, the new socket announces it.
+            presence.moved(event.recipient)
+        # Sent after what is already queued for it, then the socket is closed.
+        client.outbox.close(action, event.data)
+        return
+
+    # Never write to the socket on the publishing thread, a slow client would hold up the post.
+    client.notify(action, event.data)
+
+bus.subscribe(deliver)
\ No newline at end of file